@@ -0,0 +1 @@
+# Performance benchmarks for the microservices; run modules with python -m benchmarks.<name>
@@ -0,0 +1,43 @@
+# Compare two benchmark result files and fail on regressions.
+#
+#   python -m benchmarks.compare baseline.json current.json --threshold 0.10
+import argparse
+import json
+import sys
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative slowdown of a latency percentile that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["scenarios"]
+    with open(args.current) as f:
+        current = json.load(f)["scenarios"]
+
+    regressions = []
+    for scenario, result in current.items():
+        before = baseline.get(scenario)
+        if not before:
+            continue
+        for metric in METRICS:
+            if not before.get(metric) or result.get(metric) is None:
+                continue
+            change = result[metric] / before[metric] - 1
+            print(f"{scenario:16} {metric:7} {before[metric]:10.2f} -> {result[metric]:10.2f} ms ({change:+.1%})")
+            if change > args.threshold:
+                regressions.append(f"{scenario} {metric}")
+
+    if regressions:
+        print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Runs user, inventory, product and chart in one process. Every service is
+# loaded from its own directory, and their inter-service HTTP clients are wired
+# to each other's Flask test clients, so a benchmark exercises the real
+# request paths without sockets.
+import importlib.util
+import os
+import sys
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("user", "inventory", "product", "chart")
+
+
+def service_url(name):
+    return f"http://{name}.bench"
+
+
+# requests transport that hands each call to a Flask test client
+class FlaskAdapter(BaseAdapter):
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        result = self._client().open(
+            url.path,
+            method=request.method,
+            query_string=url.query,
+            headers=dict(request.headers),
+            data=request.body
+        )
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.reason = result.status
+        response.headers = CaseInsensitiveDict(result.headers)
+        response._content = result.get_data()
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def _service_dirs():
+    return [os.path.join(ROOT, name) for name in SERVICES]
+
+
+# Forget modules imported from any service directory, since the services
+# share module names (client, auth, ...) but must each get their own copy
+def _forget_service_modules():
+    dirs = tuple(directory + os.sep for directory in _service_dirs())
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None) or ""
+        if path.startswith(dirs):
+            del sys.modules[name]
+
+
+def load_service(name, mongo_uri):
+    directory = os.path.join(ROOT, name)
+    os.environ["MONGO_URI"] = mongo_uri
+    _forget_service_modules()
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(directory, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        _forget_service_modules()
+    return module
+
+
+# Use mongomock instead of a real mongod when no URI is given. mongomock
+# clients do not share data, so every service gets the same client, as they
+# share one mongod when deployed.
+def use_in_memory_mongo():
+    import flask_pymongo
+    import mongomock
+
+    shared = mongomock.MongoClient()
+    flask_pymongo.MongoClient = lambda *args, **kwargs: shared
+
+
+class Stack:
+    def __init__(self, mongo_uri=None):
+        self.in_memory = not mongo_uri
+        if self.in_memory:
+            use_in_memory_mongo()
+            mongo_uri = "mongodb://localhost:27017"
+        base_uri = mongo_uri.rstrip("/")
+
+        os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+        for name in SERVICES:
+            os.environ[f"{name.upper()}_MICROSERVICE_URL"] = service_url(name)
+            # Services that read another service's database find it by name
+            os.environ[f"{name.upper()}_DB_NAME"] = f"bench_{name}"
+
+        self.services = {name: load_service(name, f"{base_uri}/bench_{name}") for name in SERVICES}
+        self.adapters = {name: FlaskAdapter(module.app) for name, module in self.services.items()}
+
+        # Point every service's pooled sessions at the in-process services
+        for module in self.services.values():
+            for target, adapter in self.adapters.items():
+                module.client.get_client(target).session.mount(service_url(target), adapter)
+
+    def app(self, name):
+        return self.services[name].app
+
+    def db(self, name):
+        return self.services[name].mongo.db
+
+    def shutdown(self):
+        for module in self.services.values():
+            module.shutdown()
@@ -0,0 +1,95 @@
+"""Compare the original list serialization (a new dict per document, str() on
+every ObjectId, Flask's jsonify) with the fastjson path used by the services.
+
+    python -m benchmarks.json_encoding --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "product"))
+
+import fastjson  # noqa: E402
+
+FIELDS = ("name", "price", "quantity", "type", "inventory_id")
+
+
+def make_products(count):
+    inventory_id = str(ObjectId())
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "name": f"product-{i}",
+            "price": round(random.uniform(1, 500), 2),
+            "quantity": random.randint(1, 100),
+            "type": random.choice(("buy", "sell")),
+            "inventory_id": inventory_id,
+            "date": (start + timedelta(minutes=i)).isoformat()
+        }
+        for i in range(count)
+    ]
+
+
+def original_path(app, docs):
+    with app.app_context():
+        return jsonify([
+            {
+                "id": str(product["_id"]),
+                "name": product["name"],
+                "price": product["price"],
+                "quantity": product["quantity"],
+                "type": product["type"],
+                "inventory_id": product["inventory_id"]
+            }
+            for product in docs
+        ]).get_data()
+
+
+def fast_path(app, docs):
+    return fastjson.dumps([fastjson.as_row(doc, FIELDS) for doc in docs])
+
+
+def measure(fn, app, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        # Cursor documents are fresh on every request, and as_row edits them in place
+        docs = make_products(rows)
+        started = time.perf_counter()
+        fn(app, docs)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {"best_seconds": best, "rows_per_second": rows / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    results = {
+        "rows": args.rows,
+        "orjson": fastjson.orjson is not None,
+        "original": measure(original_path, app, args.rows, args.repeat),
+        "fastjson": measure(fast_path, app, args.rows, args.repeat),
+    }
+    results["speedup"] = results["original"]["best_seconds"] / results["fastjson"]["best_seconds"]
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
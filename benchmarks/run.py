@@ -0,0 +1,317 @@
+# Throughput and latency benchmark for the four services.
+#
+#   pip install -r benchmarks/requirements.txt
+#   python -m benchmarks.run --users 10 --inventories 2 --products 100000 --output bench.json
+#
+# Without --mongo-uri the services run on mongomock; pass a local mongod
+# (e.g. mongodb://localhost:27017) for numbers that reflect real queries.
+# Every response is checked as well as timed, and the seeded data is read
+# back once before timing starts; the run exits non-zero on any mismatch, or
+# when a scenario's error rate exceeds --max-error-rate (none by default).
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.harness import Stack
+from benchmarks.seed import PASSWORD, seed
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# Each scenario sends one request for a random (user, inventory) pair
+def signin(clients, target):
+    return clients["user"].post("/signin", json={"username": target["username"], "password": PASSWORD})
+
+
+def list_items(clients, target):
+    return clients["inventory"].get("/items", headers=target["headers"])
+
+
+def list_products(clients, target):
+    return clients["product"].get(f"/products/{target['inventory_id']}", query_string=target["page"],
+                                  headers=target["headers"])
+
+
+def spending_summary(clients, target):
+    return clients["product"].get(f"/products/summary/{target['inventory_id']}", headers=target["headers"])
+
+
+def create_product(clients, target):
+    return clients["product"].post(f"/createProduct/{target['inventory_id']}", headers=target["headers"], json={
+        "name": "benchmark", "price": 10, "quantity": 1, "type": "buy"
+    })
+
+
+def yearly_chart(clients, target):
+    return clients["chart"].get(f"/inventory-products-yearly/{target['inventory_id']}", headers=target["headers"],
+                                json={"year": datetime.utcnow().year})
+
+
+def dashboard(clients, target):
+    return clients["chart"].get(f"/dashboard/{target['inventory_id']}", headers=target["headers"],
+                                query_string={"year": datetime.utcnow().year})
+
+
+# Each check returns what is wrong with a response, or None
+def expect(response, status):
+    if response.status_code != status:
+        return f"status {response.status_code}"
+    return None
+
+
+def check_signin(response, target):
+    return expect(response, 200) or (None if response.get_json().get("access_token") else "no access_token")
+
+
+def check_items(response, target):
+    problem = expect(response, 200)
+    if problem:
+        return problem
+    rows = response.get_json()
+    if not isinstance(rows, list) or not all("id" in row for row in rows):
+        return "items are not a list of rows with ids"
+    return None
+
+
+def check_products(response, target):
+    problem = expect(response, 200)
+    if problem:
+        return problem
+    rows = response.get_json()
+    limit = target["page"].get("limit")
+    if limit and len(rows) > limit:
+        return f"{len(rows)} rows for limit {limit}"
+    if limit and len(rows) == limit and not response.headers.get("X-Next-Cursor"):
+        return "full page without X-Next-Cursor"
+    if not all(set(("id", "name", "price", "quantity", "type")) <= set(row) for row in rows):
+        return "rows are missing fields"
+    return None
+
+
+def check_summary(response, target):
+    problem = expect(response, 200)
+    if problem:
+        return problem
+    summary = response.get_json()
+    if abs(summary["total_sell"] - summary["total_buy"] - summary["total_profit"]) > 1e-6 * max(1, summary["total_buy"]):
+        return "total_profit is not total_sell - total_buy"
+    return None
+
+
+def check_created(response, target):
+    return expect(response, 201)
+
+
+def check_monthly(monthly):
+    if sorted(int(month) for month in monthly) != list(range(1, 13)):
+        return "monthly series does not have 12 months"
+    return None
+
+
+def check_yearly(response, target):
+    return expect(response, 200) or check_monthly(response.get_json())
+
+
+def check_dashboard(response, target):
+    problem = expect(response, 200)
+    if problem:
+        return problem
+    body = response.get_json()
+    if body["errors"]:
+        return f"parts failed: {', '.join(sorted(body['errors']))}"
+    return check_monthly(body["monthly"])
+
+
+# name -> (send, check)
+SCENARIOS = {
+    "signin": (signin, check_signin),
+    "items": (list_items, check_items),
+    "products": (list_products, check_products),
+    "summary": (spending_summary, check_summary),
+    "create_product": (create_product, check_created),
+    "chart_yearly": (yearly_chart, check_yearly),
+    "dashboard": (dashboard, check_dashboard),
+}
+
+
+# Read every seeded inventory of the targets back through the listing and
+# the summary: keyset pages must cover each product exactly once and agree
+# with the rollup. Returns a list of problems.
+def verify(stack, targets, page_size):
+    clients = {"product": stack.app("product").test_client()}
+    problems = []
+    for target in targets:
+        inventory_id = target["inventory_id"]
+        summary = spending_summary(clients, target)
+        if summary.status_code != 200:
+            problems.append(f"{inventory_id}: summary answered {summary.status_code}")
+            continue
+        ids = []
+        after = None
+        while True:
+            query = {"limit": page_size or 1000}
+            if after:
+                query["after"] = after
+            page = clients["product"].get(f"/products/{inventory_id}", query_string=query, headers=target["headers"])
+            if page.status_code == 404 and not ids:
+                break
+            if page.status_code != 200:
+                problems.append(f"{inventory_id}: listing answered {page.status_code}")
+                break
+            ids.extend(row["id"] for row in page.get_json())
+            after = page.headers.get("X-Next-Cursor")
+            if not after:
+                break
+        count = summary.get_json()["count"]
+        if len(ids) != len(set(ids)):
+            problems.append(f"{inventory_id}: listing returned {len(ids) - len(set(ids))} duplicate rows")
+        if len(set(ids)) != count:
+            problems.append(f"{inventory_id}: listing returned {len(set(ids))} products, summary counts {count}")
+    return problems
+
+
+def run_scenario(stack, scenario, targets, requests_count, concurrency):
+    send, check = scenario
+    latencies = []
+    errors = []
+    invalid = []
+    lock = threading.Lock()
+    remaining = [requests_count]
+
+    def worker():
+        clients = {name: stack.app(name).test_client() for name in ("user", "inventory", "product", "chart")}
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            target = random.choice(targets)
+            started = time.perf_counter()
+            response = send(clients, target)
+            elapsed = time.perf_counter() - started
+            problem = check(response, target) if response.status_code < 400 else None
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+                elif problem:
+                    invalid.append(problem)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "invalid": len(invalid),
+        "first_invalid": invalid[0] if invalid else None,
+        "throughput_rps": len(latencies) / wall if wall else None,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+        "p50_ms": 1000 * percentile(latencies, 0.50) if latencies else None,
+        "p95_ms": 1000 * percentile(latencies, 0.95) if latencies else None,
+        "p99_ms": 1000 * percentile(latencies, 0.99) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the user, inventory, product and chart services")
+    parser.add_argument("--mongo-uri", default=os.getenv("BENCH_MONGO_URI"),
+                        help="MongoDB to benchmark against; mongomock when omitted")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--inventories", type=int, default=2, help="Inventories per user")
+    parser.add_argument("--products", type=int, default=10000, help="Products per inventory")
+    parser.add_argument("--active-users", type=int, default=5, help="Users that send the benchmark requests")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--page-size", type=int, default=100, help="?limit= for /products/<id>; 0 lists everything")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--max-error-rate", type=float, default=0.0,
+                        help="Fraction of failed requests a scenario may have before the run fails")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stack = Stack(args.mongo_uri)
+    password_method = stack.services["user"].hashing.PASSWORD_HASH_METHOD
+
+    started = time.perf_counter()
+    users, inventories = seed(stack, args.users, args.inventories, args.products, password_method, args.seed)
+    seed_seconds = time.perf_counter() - started
+
+    # Sign the active users in once so the other scenarios carry real tokens
+    user_client = stack.app("user").test_client()
+    page = {"limit": args.page_size} if args.page_size else {}
+    targets = []
+    for user in users[:args.active_users]:
+        token = user_client.post("/signin", json={"username": user["username"], "password": PASSWORD}).get_json()
+        headers = {"auth-token": token["access_token"]}
+        for inventory in inventories:
+            if inventory["user_id"] == str(user["_id"]):
+                targets.append({
+                    "username": user["username"],
+                    "headers": headers,
+                    "inventory_id": str(inventory["_id"]),
+                    "page": page
+                })
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "backend": "mongomock" if stack.in_memory else "mongod",
+            "users": args.users,
+            "inventories_per_user": args.inventories,
+            "products_per_inventory": args.products,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "page_size": args.page_size,
+            "seed_seconds": seed_seconds,
+        },
+        "scenarios": {}
+    }
+    problems = verify(stack, targets, args.page_size)
+    results["meta"]["verification_problems"] = problems
+    print("verify", json.dumps({"inventories": len(targets), "problems": problems}))
+
+    for name in args.scenarios.split(","):
+        results["scenarios"][name] = run_scenario(stack, SCENARIOS[name], targets, args.requests, args.concurrency)
+        print(name, json.dumps(results["scenarios"][name]))
+
+    stack.shutdown()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if problems or any(
+        result["invalid"] or result["errors"] > args.max_error_rate * result["requests"]
+        for result in results["scenarios"].values()
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
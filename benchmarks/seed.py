@@ -0,0 +1,69 @@
+# Synthetic users, inventories and products written straight into the
+# services' collections in large batches.
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+
+BATCH_SIZE = 10000
+PASSWORD = "benchmark-password"
+
+
+def seed(stack, users, inventories_per_user, products_per_inventory, password_method, seed_value=0):
+    rng = random.Random(seed_value)
+    password_hash = generate_password_hash(PASSWORD, method=password_method)
+    start = datetime(datetime.utcnow().year, 1, 1)
+
+    user_docs = [
+        {"_id": ObjectId(), "username": f"user{i}", "email": f"user{i}@example.com", "password": password_hash}
+        for i in range(users)
+    ]
+    stack.db("user").user.insert_many(user_docs)
+
+    inventory_docs = []
+    for user in user_docs:
+        for i in range(inventories_per_user):
+            inventory_docs.append({
+                "_id": ObjectId(),
+                "name": f"inventory{i}",
+                "type": rng.choice(("retail", "wholesale")),
+                "created_date": start.isoformat(),
+                "user_id": str(user["_id"])
+            })
+    stack.db("inventory").inventory.insert_many(inventory_docs)
+
+    # Written through the service's store so PRODUCT_STORAGE is honoured
+    products = stack.services["product"].product_store
+    rollups = stack.db("product").product_rollups
+    batch = []
+    for inventory in inventory_docs:
+        user_id = inventory["user_id"]
+        inventory_id = str(inventory["_id"])
+        totals = {"buy": 0, "sell": 0}
+        for i in range(products_per_inventory):
+            product = {
+                "name": f"product{i}",
+                "price": round(rng.uniform(1, 500), 2),
+                "quantity": rng.randint(1, 100),
+                "type": rng.choice(("buy", "sell")),
+                "inventory_id": inventory_id,
+                "user_id": user_id,
+                "date": (start + timedelta(minutes=rng.randrange(365 * 24 * 60))).isoformat()
+            }
+            totals[product["type"]] += product["price"] * product["quantity"]
+            batch.append(product)
+            if len(batch) >= BATCH_SIZE:
+                products.insert_many(batch, ordered=False)
+                batch = []
+        rollups.replace_one({"_id": f"{user_id}:{inventory_id}"}, {
+            "user_id": user_id,
+            "inventory_id": inventory_id,
+            "total_buy": totals["buy"],
+            "total_sell": totals["sell"],
+            "count": products_per_inventory
+        }, upsert=True)
+    if batch:
+        products.insert_many(batch, ordered=False)
+
+    return user_docs, inventory_docs
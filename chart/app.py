@@ -1,96 +1,192 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_pymongo import PyMongo
-from bson import ObjectId
 from flask_jwt_extended import JWTManager
-from flask_jwt_extended.utils import decode_token
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-import logging
 import requests
+import auth
+from auth import authenticate
+from revocation import revoked_tokens
+import client
+import resilience
+import metrics
+import tracing
+from client import DeadlineExceeded, get_client
+from resilience import CircuitOpenError
+import ownership
+import changefeed
+import fanout
+import fastjson
+import conditional
 
 load_dotenv()
 
 app = Flask(__name__)
 
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
-mongo = PyMongo(app)
+# connect=False defers connecting until first use, which keeps the client
+# fork-safe; the pool size is per worker process
+mongo = PyMongo(app, connect=False, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+                event_listeners=[metrics.mongo_listener])
 
-app.config["JWT_SECRET_KEY"] = "123456"
+app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "123456")
 jwt = JWTManager(app)
+client.init_app(app)
+resilience.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, "chart")
+fastjson.init_app(app)
+ownership.init_app(app)
+# Tokens revoked by logout, read from the user service's database
+revoked_tokens.init_app(mongo.cx[changefeed.DATABASES["user"]].revoked_tokens)
+# Drop cached identities and ownership as soon as another service changes them
+auth.subscribe(changefeed.feed)
+ownership.subscribe(changefeed.feed)
+changefeed.feed.init_app(mongo.cx, mongo.db.changefeed_tokens, "chart")
 
 
-import requests
-
 PRODUCT_MICROSERVICE_URL = os.getenv("PRODUCT_MICROSERVICE_URL")
 USER_MICROSERVICE_URL = os.getenv("USER_MICROSERVICE_URL")
 INVENTORY_MICROSERVICE_URL = os.getenv("INVENTORY_MICROSERVICE_URL")
 
+# Longest wait for any one part of the dashboard before it is left out
+DASHBOARD_PART_TIMEOUT = float(os.getenv("DASHBOARD_PART_TIMEOUT", "2"))
+DASHBOARD_RECENT_PRODUCTS = int(os.getenv("DASHBOARD_RECENT_PRODUCTS", "10"))
+MAX_DASHBOARD_RECENT_PRODUCTS = 100
+
 # For inter service communication between user and inventory
 def get_user_id_from_body():
-    auth_header = request.headers.get("auth-token")
-    
-    if not auth_header:
-        return None, None, None, "Token is missing"
-
-    try:
-        # Call the user microservice to get user details
-        response = requests.get(
-            f"{os.getenv('USER_MICROSERVICE_URL')}/user_id",
-            headers={"auth-token": auth_header}
-        )
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            return user_data["user_id"], user_data["username"], user_data["email"], None
-        elif response.status_code == 401:
-            return None, None, None, "Invalid token"
-        else:
-            return None, None, None, "User not found or unauthorized"
-    
-    except Exception as e:
-        return None, None, None, f"Error occurred: {str(e)}"
+    # The token is verified locally; the user service is only a fallback
+    return authenticate(request.headers.get("auth-token"))
 
+@metrics.phase("ownership")
 def check_inventory(inventory_id):
+    # Serve repeated checks from the ownership cache
+    auth_header = request.headers.get("auth-token")
+    user_id = authenticate(auth_header)[0]
+    if user_id:
+        owned = ownership.cached_ownership(user_id, inventory_id)
+        if owned is not None:
+            return owned
+
     try:
         # Call the inventory microservice to check if the inventory item exists
-        inventory_service_url = f"{os.getenv('INVENTORY_MICROSERVICE_URL')}/checkInventory/{inventory_id}"
-        auth_header = request.headers.get("auth-token")
         # Include the auth token in the headers for authentication
         headers = {"auth-token": auth_header}
-        response = requests.get(inventory_service_url, headers=headers)
+        response = get_client("inventory").get(f"/checkInventory/{inventory_id}", headers=headers)
 
         if response.status_code == 200:
             # If the inventory item exists and is owned by the user
-            return True
+            owned = True
         elif response.status_code == 403:
             # The inventory item exists but does not belong to the user
-            return False
+            owned = False
         elif response.status_code == 404:
             # The inventory item does not exist
-            return False
+            owned = False
         else:
             # Handle unexpected status codes
             raise Exception("Error checking inventory: unexpected response")
 
+        if user_id:
+            ownership.remember_ownership(user_id, inventory_id, owned)
+        return owned
+
+    except (DeadlineExceeded, CircuitOpenError):
+        raise
     except requests.exceptions.RequestException as e:
         raise Exception(f"Error occurred while contacting inventory service: {str(e)}")
 
 
 
+# Raised to answer a request early with {"msg": msg} and the given status
+class RequestRejected(Exception):
+    def __init__(self, msg, status):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+@app.errorhandler(RequestRejected)
+def request_rejected(e):
+    return jsonify({"msg": e.msg}), e.status
+
+# Hold back the errors of a fan-out call until the caller is known to be
+# authorized, so a failing dependency never masks a 401 or 403
+def defer_errors(call):
+    def run():
+        try:
+            return call(), None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            return None, e
+    return run
+
+# Authenticate the caller, check inventory ownership and run any further
+# independent calls concurrently. Returns (user_id, [results of calls]) or
+# raises RequestRejected when the caller may not see the inventory.
+def authorize_inventory(inventory_ID, not_owned_msg, not_owned_status, *calls):
+    def authenticate_caller():
+        user_id, username, email, error = get_user_id_from_body()
+        if error:
+            raise RequestRejected(error, 401)
+        return user_id
+
+    def check_ownership():
+        try:
+            owned = check_inventory(inventory_ID)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # An invalid token also fails here; let authentication decide first
+            return e
+        if not owned:
+            raise RequestRejected(not_owned_msg, not_owned_status)
+        return None
+
+    results = fanout.gather(authenticate_caller, check_ownership, *map(defer_errors, calls))
+    user_id, ownership_error = results[:2]
+    if ownership_error:
+        raise ownership_error
+    values = []
+    for value, error in results[2:]:
+        if error:
+            raise error
+        values.append(value)
+    return user_id, values
+
+# Buy/sell totals grouped server-side by the product service
+def fetch_timeseries(inventory_ID, params, headers):
+    return get_client("product").get(f"/products/timeseries/{inventory_ID}", params=params, headers=headers)
+
+# Chart ETags are the product timeseries ETag plus a suffix per chart shape;
+# If-None-Match is forwarded so the product service can answer 304
+DAILY_ETAG_SUFFIX = "-daily"
+YEARLY_ETAG_SUFFIX = "-yearly"
+
+def empty_bucket(bucket):
+    return {"bucket": bucket, "total_buy": 0, "total_sell": 0, "buy_count": 0, "sell_count": 0, "count": 0}
+
+# Place monthly buckets ("YYYY-MM") of one year in a 1..12 series; buckets
+# that do not name a month of the series (lines with malformed dates) are
+# left out
+def monthly_series(year, buckets):
+    monthly_data = {month: empty_bucket(f"{year:04d}-{month:02d}") for month in range(1, 13)}
+    for bucket in buckets:
+        try:
+            month = int(str(bucket.get("bucket"))[5:7])
+        except ValueError:
+            continue
+        if month in monthly_data:
+            monthly_data[month] = bucket
+    return monthly_data
+
 # A route to send montly buy and sell to the frontend for cart represntation
 @app.route('/inventory-products/<inventory_ID>', methods=['GET'])
 def get_inventory_products(inventory_ID):
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401
-
-    # Ensure the inventory item exists and belongs to the user
-    if not check_inventory(inventory_ID):
-        return jsonify({"msg": "Unauthorized or inventory item not found"}), 403
-
     # Get the request body
-    data = request.get_json()
+    data = request.get_json(silent=True)
 
     # Validate input data for month and year
     if not data or 'month' not in data:
@@ -108,41 +204,39 @@ def get_inventory_products(inventory_ID):
 
     # Set up headers for the request to the product service
     headers = {"auth-token": request.headers.get("auth-token")}
+    if_none_match = conditional.upstream_if_none_match(DAILY_ETAG_SUFFIX)
+    if if_none_match:
+        headers["If-None-Match"] = if_none_match
 
-    # Call the product service to get products for the specified inventory
+    # Ask the product service for the daily totals of that month while the
+    # caller is authenticated and the inventory ownership is checked
     try:
-        response = requests.get(
-            f"{PRODUCT_MICROSERVICE_URL}/products/{inventory_ID}", 
-            headers=headers
+        user_id, (response,) = authorize_inventory(
+            inventory_ID,
+            "Unauthorized or inventory item not found", 403,
+            lambda: fetch_timeseries(inventory_ID, {"granularity": "day", "year": year, "month": month}, headers)
         )
 
+        etag = conditional.derived_etag(response, DAILY_ETAG_SUFFIX)
+        if response.status_code == 304:
+            return conditional.not_modified(etag)
+
         # If the product service returns an error status, propagate it
         if response.status_code != 200:
             return jsonify({"msg": response.json().get("msg", "Failed to fetch products")}), response.status_code
 
-        # Return the products retrieved from the product service
-        products_data = response.json()
-
-        # Sort products by created_date in descending order
-        sorted_products = sorted(products_data, key=lambda x: x['created_date'], reverse=True)
-
-        return jsonify(sorted_products), 200
+        # The daily buckets are passed through without decoding them
+        return conditional.tagged(Response(response.content, status=200, mimetype="application/json"), etag)
 
+    except (DeadlineExceeded, CircuitOpenError):
+        raise
     except requests.exceptions.RequestException as e:
         return jsonify({"msg": f"Error communicating with product service: {str(e)}"}), 500
 
 @app.route('/inventory-products-yearly/<inventory_ID>', methods=['GET'])
 def get_inventory_products_by_year(inventory_ID):
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401
-
-    # Ensure the inventory item exists and belongs to the user
-    if not check_inventory(inventory_ID):
-        return jsonify({"msg": "Unauthorized or inventory item not found"}), 403
-
     # Get year from request body
-    data = request.get_json()
+    data = request.get_json(silent=True)
 
     if not data or 'year' not in data:
         return jsonify({"msg": "Invalid input data. Required field: 'year'."}), 400
@@ -153,32 +247,120 @@ def get_inventory_products_by_year(inventory_ID):
         return jsonify({"msg": "Year must be a positive integer."}), 400
 
     headers = {"auth-token": request.headers.get("auth-token")}
+    if_none_match = conditional.upstream_if_none_match(YEARLY_ETAG_SUFFIX)
+    if if_none_match:
+        headers["If-None-Match"] = if_none_match
 
-    # Dictionary to store monthly data
-    monthly_data = {month: [] for month in range(1, 13)}
-
-    # Fetch and group products by month for the specified year
+    # Fetch the monthly totals of the specified year in a single call, alongside
+    # authentication and the ownership check
     try:
-        for month in range(1, 13):
-            response = requests.get(
-                f"{PRODUCT_MICROSERVICE_URL}/products/{inventory_ID}?month={month}&year={year}", 
-                headers=headers
-            )
+        user_id, (response,) = authorize_inventory(
+            inventory_ID,
+            "Unauthorized or inventory item not found", 403,
+            lambda: fetch_timeseries(inventory_ID, {"granularity": "month", "year": year}, headers)
+        )
 
-            if response.status_code == 200:
-                products_data = response.json()
-                sorted_products = sorted(products_data, key=lambda x: x['created_date'], reverse=True)
-                monthly_data[month] = sorted_products
-            else:
-                monthly_data[month] = []
+        etag = conditional.derived_etag(response, YEARLY_ETAG_SUFFIX)
+        if response.status_code == 304:
+            return conditional.not_modified(etag)
 
-        return jsonify(monthly_data), 200
+        if response.status_code != 200:
+            return jsonify({"msg": response.json().get("msg", "Failed to fetch products")}), response.status_code
+
+        monthly_data = monthly_series(year, response.json())
+        return conditional.tagged(fastjson.json_response(monthly_data), etag)
 
+    except (DeadlineExceeded, CircuitOpenError):
+        raise
     except requests.exceptions.RequestException as e:
         return jsonify({"msg": f"Error communicating with product service: {str(e)}"}), 500
 
 
+# Raised by a dashboard part when its service answers with an error status
+class PartFailed(Exception):
+    def __init__(self, msg, status):
+        super().__init__(msg)
+        self.status = status
+
+def fetch_part(service, path, headers, params=None, missing=None):
+    response = get_client(service).get(path, params=params, headers=headers, timeout=DASHBOARD_PART_TIMEOUT)
+    if response.status_code == 404 and missing is not None:
+        return missing
+    if response.status_code != 200:
+        try:
+            msg = response.json().get("msg") or response.json().get("error")
+        except ValueError:
+            msg = None
+        raise PartFailed(msg or f"{service} service returned {response.status_code}", response.status_code)
+    return response.json()
+
+def part_error(error):
+    if isinstance(error, PartFailed):
+        return {"msg": str(error), "status": error.status}
+    if isinstance(error, DeadlineExceeded):
+        return {"msg": "Timed out", "status": 504}
+    if isinstance(error, CircuitOpenError):
+        return {"msg": str(error), "status": 503}
+    return {"msg": f"Error communicating with downstream service: {str(error)}", "status": 502}
+
+# Everything one inventory page shows, in a single response: the inventory
+# item, its spending summary, the most recent products and the monthly series
+# of ?year=. The caller is authenticated and ownership is checked once, then
+# the parts are fetched concurrently; a part that fails or takes longer than
+# DASHBOARD_PART_TIMEOUT is left out and reported under "errors".
+@app.route('/dashboard/<inventory_ID>', methods=['GET'])
+def get_dashboard(inventory_ID):
+    try:
+        year = int(request.args.get("year", datetime.utcnow().year))
+        recent = int(request.args.get("recent", DASHBOARD_RECENT_PRODUCTS))
+    except ValueError:
+        return jsonify({"msg": "'year' and 'recent' must be integers."}), 400
+    if year < 0:
+        return jsonify({"msg": "Year must be a positive integer."}), 400
+    if not 1 <= recent <= MAX_DASHBOARD_RECENT_PRODUCTS:
+        return jsonify({"msg": f"'recent' must be between 1 and {MAX_DASHBOARD_RECENT_PRODUCTS}."}), 400
+
+    headers = {"auth-token": request.headers.get("auth-token")}
+    parts = {
+        "item": lambda: fetch_part("inventory", f"/items/{inventory_ID}", headers),
+        "summary": lambda: fetch_part("product", f"/products/summary/{inventory_ID}", headers),
+        "recent_products": lambda: fetch_part("product", f"/products/{inventory_ID}", headers,
+                                              {"sort": "desc", "limit": recent}, missing=[]),
+        "monthly": lambda: fetch_part("product", f"/products/timeseries/{inventory_ID}", headers,
+                                      {"granularity": "month", "year": year}),
+    }
+
+    # Authorization fans out into the same bounded pool, so it runs before
+    # the parts are queued there rather than waiting behind them
+    authorize_inventory(inventory_ID, "Unauthorized or inventory item not found", 403)
+    futures = fanout.submit(*parts.values())
+
+    remaining = client.remaining_budget()
+    timeout = DASHBOARD_PART_TIMEOUT if remaining is None else max(min(DASHBOARD_PART_TIMEOUT, remaining), 0)
+    dashboard = {"inventory_id": inventory_ID}
+    errors = {}
+    for name, (value, error) in zip(parts, fanout.settle(futures, timeout=timeout)):
+        if error:
+            dashboard[name] = None
+            errors[name] = part_error(error)
+        else:
+            dashboard[name] = value
+
+    if dashboard["monthly"] is not None:
+        dashboard["monthly"] = monthly_series(year, dashboard["monthly"])
+
+    dashboard["errors"] = errors
+    return fastjson.json_response(dashboard)
+
+
+# Release pooled connections when a worker stops
+def shutdown():
+    changefeed.feed.stop()
+    client.close_clients()
+    fanout.shutdown()
+    mongo.cx.close()
 
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True, port=5003)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5003, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,48 @@
+import hashlib
+
+from flask import Response, make_response, request
+from werkzeug.http import quote_etag, unquote_etag
+
+# Clients may keep responses but must revalidate them on every use
+CACHE_CONTROL = "private, no-cache"
+
+
+# Strong ETag of the current request's representation at the given version.
+# The path and query string are part of it, so every page, filter and field
+# selection of the same data gets its own tag.
+def make_etag(*version):
+    key = repr((version, request.path, request.query_string))
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
+
+
+# A 304 response when the client already holds this representation, else None
+def not_modified(etag):
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+def tagged(response, etag):
+    response = make_response(response)
+    if etag is not None and response.status_code == 200:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+# Responses derived from another service's response are tagged with that
+# service's ETag plus a suffix naming the derivation. These turn the tags a
+# client sends back into the upstream ones, and the other way round.
+def upstream_if_none_match(suffix):
+    tags = [tag[:-len(suffix)] for tag in request.if_none_match.as_set() if tag.endswith(suffix)]
+    return ", ".join(quote_etag(tag) for tag in tags) or None
+
+
+def derived_etag(upstream_response, suffix):
+    etag = upstream_response.headers.get("ETag")
+    if not etag:
+        return None
+    return unquote_etag(etag)[0] + suffix
@@ -0,0 +1,89 @@
+import os
+
+from flask import jsonify, request
+
+from auth import authenticate
+from cache import TTLCache
+from client import get_client
+
+# (user_id, inventory_id) -> owned. Ownership almost never changes, so positive
+# answers are reused; negative answers only briefly.
+#
+# The invalidation call made when an inventory is deleted reaches only the
+# worker that receives it. Every other worker keeps authorizing the deleted
+# inventory until its entry expires, so OWNERSHIP_CACHE_TTL is the bound on
+# that staleness. Keep it short unless the change feed (CHANGEFEED_ENABLED)
+# invalidates every worker.
+ownership_cache = TTLCache(
+    maxsize=int(os.getenv("OWNERSHIP_CACHE_SIZE", "50000")),
+    ttl=int(os.getenv("OWNERSHIP_CACHE_TTL", "30")),
+)
+OWNERSHIP_NEGATIVE_TTL = int(os.getenv("OWNERSHIP_NEGATIVE_TTL", "5"))
+# Ids per /checkInventory/batch call; the inventory service caps it at 1000
+OWNERSHIP_BATCH_SIZE = int(os.getenv("OWNERSHIP_BATCH_SIZE", "1000"))
+
+
+def cached_ownership(user_id, inventory_id):
+    return ownership_cache.get((user_id, inventory_id))
+
+
+def remember_ownership(user_id, inventory_id, owned):
+    ttl = None if owned else OWNERSHIP_NEGATIVE_TTL
+    ownership_cache.set((user_id, inventory_id), owned, ttl=ttl)
+
+
+def invalidate_inventory(inventory_id):
+    return ownership_cache.invalidate_if(lambda key, owned: key[1] == inventory_id)
+
+
+# Warm the cache for many inventories with one call to the inventory service
+# per OWNERSHIP_BATCH_SIZE uncached ids. Returns {inventory_id: owned} for
+# every id, cached or not.
+def preload_ownership(token, inventory_ids):
+    user_id = authenticate(token)[0]
+    if not user_id:
+        return {}
+
+    owned = {}
+    missing = []
+    for inventory_id in inventory_ids:
+        cached = cached_ownership(user_id, inventory_id)
+        if cached is None:
+            missing.append(inventory_id)
+        else:
+            owned[inventory_id] = cached
+
+    for start in range(0, len(missing), OWNERSHIP_BATCH_SIZE):
+        response = get_client("inventory").post(
+            "/checkInventory/batch",
+            json={"ids": missing[start:start + OWNERSHIP_BATCH_SIZE]},
+            headers={"auth-token": token}
+        )
+        response.raise_for_status()
+        for inventory_id, is_owned in response.json()["owned"].items():
+            remember_ownership(user_id, inventory_id, is_owned)
+            owned[inventory_id] = is_owned
+    return owned
+
+
+# Forget ownership of inventories changed or deleted by the inventory service
+def subscribe(feed):
+    feed.subscribe("inventory", "inventory", lambda event: invalidate_inventory(str(event["documentKey"]["_id"])),
+                   on_reset=ownership_cache.clear)
+
+
+def init_app(app):
+    # Called by the inventory service when an inventory is deleted. Only the
+    # worker that answers forgets the inventory; see ownership_cache.
+    @app.route('/internal/ownership/invalidate', methods=['POST'])
+    def invalidate_ownership():
+        user_id, username, email, error = authenticate(request.headers.get("auth-token"))
+        if error:
+            return jsonify({"msg": error}), 401
+
+        data = request.get_json(silent=True)
+        if not data or 'inventory_id' not in data:
+            return jsonify({"msg": "Invalid input data. Required field: 'inventory_id'."}), 400
+
+        removed = invalidate_inventory(str(data['inventory_id']))
+        return jsonify({"invalidated": removed}), 200
@@ -1,75 +1,147 @@
 from flask import Flask, jsonify, request
 from flask_pymongo import PyMongo
 from bson import ObjectId
-from flask_jwt_extended import JWTManager
-from flask_jwt_extended.utils import decode_token
-from datetime import datetime
+from bson.errors import InvalidId
+from flask_jwt_extended import JWTManager, create_access_token
+from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
 import logging
 import requests
+import auth
+from auth import authenticate
+from revocation import revoked_tokens
+import client
+import resilience
+import metrics
+import tracing
+from client import get_client
+import indexes
+import pagination
+import fastjson
+import outbox
+import changefeed
+import conditional
+from pymongo import ASCENDING, IndexModel, ReturnDocument
 
 load_dotenv()
 
 app = Flask(__name__)
 
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
-mongo = PyMongo(app)
+# connect=False defers connecting until first use, which keeps the client
+# fork-safe; the pool size is per worker process
+mongo = PyMongo(app, connect=False, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+                event_listeners=[metrics.mongo_listener])
 
-app.config["JWT_SECRET_KEY"] = "123456"
+app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "123456")
 jwt = JWTManager(app)
+client.init_app(app)
+resilience.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, "inventory")
+fastjson.init_app(app)
 
 # Collection references
 inventory_collection = mongo.db.inventory
 
+# Cascading product deletes still to be carried out
+outbox_collection = mongo.db.deletion_outbox
+
+# One counter per user, bumped by every write to their items, that versions
+# the /items listing
+item_versions_collection = mongo.db.item_versions
+
+indexes.init_app(app, [
+    (inventory_collection, [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id_id")
+    ]),
+    (outbox_collection, [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt_at"),
+        IndexModel([("inventory_id", ASCENDING), ("user_id", ASCENDING)], name="inventory_id_user_id")
+    ])
+])
+
+OWNERSHIP_INVALIDATION_TIMEOUT = float(os.getenv("OWNERSHIP_INVALIDATION_TIMEOUT", "1"))
+# Products removed per call while draining a deleted inventory
+PURGE_CHUNK_SIZE = int(os.getenv("PURGE_CHUNK_SIZE", "1000"))
+MAX_BATCH_CHECK_SIZE = int(os.getenv("MAX_BATCH_CHECK_SIZE", "1000"))
+
+# Tokens revoked by logout, read from the user service's database
+revoked_tokens.init_app(mongo.cx[changefeed.DATABASES["user"]].revoked_tokens)
+# Drop cached identities as soon as the user service changes or revokes them
+auth.subscribe(changefeed.feed)
+changefeed.feed.init_app(mongo.cx, mongo.db.changefeed_tokens, "inventory")
+
 # For inter service communication between user and inventory
 def get_user_id_from_body():
-    auth_header = request.headers.get("auth-token")
-    
-    if not auth_header:
-        return None, None, None, "Token is missing"
-
-    try:
-        # Call the user microservice to get user details
-        response = requests.get(
-            f"{os.getenv('USER_MICROSERVICE_URL')}/user_id",
-            headers={"auth-token": auth_header}
+    # The token is verified locally; the user service is only a fallback
+    return authenticate(request.headers.get("auth-token"))
+
+# Call after a write to a user's items, never before, so a tag is never
+# handed out for data that is not visible yet
+def bump_items_version(user_id):
+    item_versions_collection.update_one(
+        {"_id": user_id},
+        {"$inc": {"version": 1}, "$setOnInsert": {"epoch": ObjectId()}},
+        upsert=True
+    )
+
+# (epoch, version) of a user's items. The epoch is set when the counter is
+# created, so tags from before it existed can never match.
+def items_version(user_id):
+    counter = item_versions_collection.find_one({"_id": user_id})
+    if counter is None:
+        counter = item_versions_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": {"version": 0, "epoch": ObjectId()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            return user_data["user_id"], user_data["username"], user_data["email"], None
-        elif response.status_code == 401:
-            return None, None, None, "Invalid token"
-        else:
-            return None, None, None, "User not found or unauthorized"
-    
-    except Exception as e:
-        return None, None, None, f"Error occurred: {str(e)}"
-
-def delete_all_product(inventory_id):
-    auth_header = request.headers.get("auth-token")
-    if not auth_header:
-        return None, "Token is missing"
-    try:
-        # Make a DELETE request to the product microservice
-        product_service_url = f"{os.getenv('PRODUCT_MICROSERVICE_URL')}/products/delete_all/{inventory_id}"
-        headers = {"auth-token": auth_header}
-        response = requests.get(product_service_url, headers=headers)
-        print(response.status_code,response.json())
-        # Check response status
-        if response.status_code == 200:
-            return response.json(), None
-        elif response.status_code == 404:
-            return None, response.json()
-        elif response.status_code == 401:
-            return None, "Invalid token"
-        else:
-            error_msg = response.json().get("msg", "Unexpected error")
-            return None, f"Error: {error_msg}"
-    
-    except requests.exceptions.RequestException as e:
-        return None, f"Error occurred while contacting product service: {str(e)}"
+    return str(counter["epoch"]), counter["version"]
+
+# Remove one chunk of a deleted inventory's products through the product
+# service, authenticated with a short-lived service token for the owner
+def purge_products(entry):
+    with app.app_context():
+        token = create_access_token(
+            identity=entry["user_id"],
+            additional_claims={"username": entry["username"], "email": entry["email"], "svc": "inventory"},
+            expires_delta=timedelta(minutes=5)
+        )
+    response = get_client("product").post(
+        f"/internal/products/purge/{entry['inventory_id']}",
+        json={"limit": PURGE_CHUNK_SIZE},
+        headers={"auth-token": token}
+    )
+    if response.status_code != 200:
+        raise Exception(f"Product service answered {response.status_code}: {response.text}")
+    result = response.json()
+    return result["deleted"], result["done"]
+
+# Tell the services that cache inventory ownership to forget a deleted inventory
+def notify_inventory_deleted(inventory_id):
+    headers = {"auth-token": request.headers.get("auth-token")}
+    for service in ("product", "chart"):
+        service_client = get_client(service)
+        if not service_client.base_url:
+            continue
+        try:
+            service_client.post(
+                "/internal/ownership/invalidate",
+                json={"inventory_id": inventory_id},
+                headers=headers,
+                timeout=OWNERSHIP_INVALIDATION_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            # Cached entries still expire on their own, so this is best effort
+            logging.warning(f"Failed to invalidate ownership of {inventory_id} in {service} service: {str(e)}")
+
+def inventory_exists(entry):
+    return inventory_collection.find_one({"_id": ObjectId(entry["inventory_id"])}, {"_id": 1}) is not None
+
+outbox_worker = outbox.OutboxWorker(outbox_collection, purge_products, inventory_exists)
+outbox_worker.start()
 
 
 @app.route('/', methods=['GET'])
@@ -100,6 +172,40 @@ def checkInventory(inventory_ID):
         return jsonify({"msg": f"Error occurred while checking inventory: {str(e)}"}), 500
 
 
+ITEM_FIELDS = ("name", "type", "created_date", "user_id")
+ITEM_SORT = [("_id", ASCENDING)]
+
+# Check ownership of many inventories at once: {"ids": [...]} -> {"owned": {id: bool}}
+@app.route('/checkInventory/batch', methods=['POST'])
+def check_inventory_batch():
+    user_id, username, email, error = get_user_id_from_body()
+    if error:
+        return jsonify({"msg": error}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list):
+        return jsonify({"msg": "Invalid input data. Required field: 'ids'."}), 400
+    if len(data['ids']) > MAX_BATCH_CHECK_SIZE:
+        return jsonify({"msg": f"At most {MAX_BATCH_CHECK_SIZE} ids can be checked per request"}), 400
+
+    owned = {str(inventory_id): False for inventory_id in data['ids']}
+    object_ids = []
+    for inventory_id in owned:
+        try:
+            object_ids.append(ObjectId(inventory_id))
+        except InvalidId:
+            # Malformed ids cannot name an inventory
+            pass
+
+    try:
+        for item in inventory_collection.find({"_id": {"$in": object_ids}, "user_id": user_id}, {"_id": 1}):
+            owned[str(item["_id"])] = True
+    except Exception as e:
+        return jsonify({"msg": f"Error occurred while checking inventory: {str(e)}"}), 500
+
+    return jsonify({"owned": owned}), 200
+
+
 # Get Item is completed
 @app.route('/items', methods=['GET'])
 def get_items():
@@ -107,18 +213,34 @@ def get_items():
     if error:
         return jsonify({"msg": error}), 401
 
+    try:
+        fields = pagination.requested_fields(ITEM_FIELDS)
+        limit, after = pagination.page_params(ITEM_SORT)
+        mode = pagination.stream_mode()
+    except pagination.PaginationError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    # Unchanged since the client's copy: answer from the counter alone
+    etag = conditional.make_etag(*items_version(user_id))
+    response = conditional.not_modified(etag)
+    if response:
+        return response
+
     # Proceed with fetching items if the user_id is valid
-    items = inventory_collection.find({"user_id": user_id})
-    return jsonify([
-        {
-            "id": str(item["_id"]),
-            "name": item["name"],
-            "type": item["type"],
-            "created_date": item["created_date"],
-            "user_id": item["user_id"]
-        }
-        for item in items
-    ]), 200
+    query = pagination.apply_after({"user_id": user_id}, after, ITEM_SORT)
+    items = inventory_collection.find(query, pagination.projection(fields, ITEM_SORT)).sort(ITEM_SORT)
+    if limit:
+        items = items.limit(limit)
+
+    # Rows are encoded from the projected documents without copying them
+    def serialize(item):
+        return fastjson.as_row(item, fields)
+
+    if mode:
+        return conditional.tagged(pagination.stream_response(items, serialize, mode), etag)
+
+    rows, next_cursor = pagination.collect_page(items, serialize, ITEM_SORT, limit)
+    return conditional.tagged(pagination.page_response(rows, next_cursor), etag)
 
 # Get Item by Id is completed
 @app.route('/items/<item_id>', methods=['GET'])
@@ -130,13 +252,18 @@ def get_item(item_id):
     # Fetch the item and check that it belongs to the authenticated user
     item = mongo.db.inventory.find_one({"_id": ObjectId(item_id), "user_id": user_id})
     if item:
-        return jsonify({
+        etag = conditional.make_etag(item_id, item.get("version", 0))
+        response = conditional.not_modified(etag)
+        if response:
+            return response
+
+        return conditional.tagged(jsonify({
             "id": str(item["_id"]),
             "name": item["name"],
             "type": item["type"],
             "created_date": item["created_date"],
             "user_id": item["user_id"]
-        }), 200
+        }), etag)
     
     return jsonify({"error": "Item not found or unauthorized"}), 404
 
@@ -163,7 +290,8 @@ def create_item():
 
     try:
         # Insert the item into the inventory collection
-        result = mongo.db.inventory.insert_one(new_item)
+        result = mongo.db.inventory.insert_one(dict(new_item, version=1))
+        bump_items_version(user_id)
         new_item["_id"] = str(result.inserted_id)
         return jsonify(new_item), 201
     except Exception as e:
@@ -192,7 +320,8 @@ def update_item(item_id):
         }
         
         # Update the item in the database
-        mongo.db.inventory.update_one({"_id": ObjectId(item_id)}, {"$set": updated_data})
+        mongo.db.inventory.update_one({"_id": ObjectId(item_id)}, {"$set": updated_data, "$inc": {"version": 1}})
+        bump_items_version(user_id)
         item.update(updated_data)
 
         return jsonify({
@@ -214,29 +343,75 @@ def delete_item(item_id):
         return jsonify({"msg": error}), 401
 
     try:
-        # First, delete all related products
-        logging.info(f"Deleting all related products for item {item_id}")
-        delete_result, delete_error = delete_all_product(item_id)
-        if delete_error:
-            logging.error(f"Failed to delete related products for item {item_id}: {delete_error}")
-            return jsonify({"error": f"Failed to delete related products: {delete_error}"}), 500
-
-        # If product deletion is successful, proceed to delete the item from inventory
+        object_id = ObjectId(item_id)
+    except InvalidId:
+        return jsonify({"error": "Item not found or unauthorized"}), 404
+
+    entry_id = None
+    try:
+        # Reserve the cascading product delete first so it survives a crash;
+        # the outbox worker deletes the products in the background once the
+        # entry is confirmed
+        logging.info(f"Queueing deletion of all related products for item {item_id}")
+        entry_id = outbox.enqueue(outbox_collection, item_id, user_id, username, email)
+
         logging.info(f"Attempting to delete item {item_id} from inventory for user {username} (ID: {user_id})")
-        result = mongo.db.inventory.delete_one({"_id": ObjectId(item_id), "user_id": user_id})
+        result = mongo.db.inventory.delete_one({"_id": object_id, "user_id": user_id})
 
         if result.deleted_count:
             logging.info(f"Successfully deleted item {item_id} from inventory for user {username} (ID: {user_id})")
-            return jsonify({"msg": "Item and all related products deleted successfully"}), 204
+            outbox.confirm(outbox_collection, entry_id)
+            bump_items_version(user_id)
+            notify_inventory_deleted(item_id)
+            return jsonify({
+                "msg": "Item deleted, related products are being deleted",
+                "deletion": f"/items/{item_id}/deletion"
+            }), 202
         else:
+            outbox.cancel(outbox_collection, entry_id)
             logging.warning(f"Item not found or unauthorized for user {username} (ID: {user_id})")
             return jsonify({"error": "Item not found or unauthorized"}), 404
 
     except Exception as e:
         logging.error(f"Exception occurred while deleting item {item_id}: {str(e)}")
+        # The delete may or may not have happened; an entry left reserved is
+        # only carried out if the inventory turns out to be gone
+        if entry_id is not None:
+            try:
+                if inventory_collection.find_one({"_id": object_id}, {"_id": 1}):
+                    outbox.cancel(outbox_collection, entry_id)
+            except Exception as e:
+                logging.warning(f"Failed to cancel the deletion of {item_id}'s products: {str(e)}")
         return jsonify({"error": "Failed to delete item"}), 500
 
+# Progress of the background product deletion of a deleted item
+@app.route('/items/<item_id>/deletion', methods=['GET'])
+def get_item_deletion(item_id):
+    user_id, username, email, error = get_user_id_from_body()
+    if error:
+        return jsonify({"msg": error}), 401
+
+    entry = outbox_collection.find_one({"inventory_id": item_id, "user_id": user_id}, sort=[("created_at", -1)])
+    if not entry:
+        return jsonify({"error": "No deletion found for this item"}), 404
+
+    return jsonify({
+        "inventory_id": item_id,
+        "status": entry["status"],
+        "deleted": entry.get("deleted", 0),
+        "attempts": entry.get("attempts", 0),
+        "last_error": entry.get("last_error")
+    }), 200
+
+
+# Release pooled connections when a worker stops
+def shutdown():
+    changefeed.feed.stop()
+    outbox_worker.stop()
+    client.close_clients()
+    mongo.cx.close()
 
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,87 @@
+import os
+import time
+
+from flask_jwt_extended.utils import decode_token
+
+import metrics
+from cache import TTLCache
+from client import DeadlineExceeded, get_client
+from resilience import CircuitOpenError
+from revocation import revoked_tokens
+
+# Identity claims and jti of tokens we already verified, keyed by the raw
+# token. Entries never outlive the token itself.
+identity_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("AUTH_CACHE_TTL", "300")),
+)
+
+
+# Ask the user microservice for the identity behind a token.
+# Only used when the token does not carry the claims we need.
+def fetch_identity(token):
+    try:
+        response = get_client("user").get("/user_id", headers={"auth-token": token})
+
+        if response.status_code == 200:
+            user_data = response.json()
+            return user_data["user_id"], user_data["username"], user_data["email"], None
+        elif response.status_code == 401:
+            return None, None, None, "Invalid token"
+        else:
+            return None, None, None, "User not found or unauthorized"
+
+    except (DeadlineExceeded, CircuitOpenError):
+        raise
+    except Exception as e:
+        return None, None, None, f"Error occurred: {str(e)}"
+
+
+# Verify the token signature and expiry in-process with the app's JWTManager
+# and return (user_id, username, email, error). Tokens revoked by logout are
+# refused once the revocation list has synced them from the user database.
+@metrics.phase("auth")
+def authenticate(token):
+    if not token:
+        return None, None, None, "Token is missing"
+
+    cached = identity_cache.get(token)
+    if cached:
+        identity, jti = cached
+        if revoked_tokens.is_revoked(jti):
+            return None, None, None, "Token has been revoked"
+        return identity + (None,)
+
+    try:
+        claims = decode_token(token)
+    except Exception:
+        return None, None, None, "Invalid token"
+    if revoked_tokens.is_revoked(claims.get("jti")):
+        return None, None, None, "Token has been revoked"
+
+    user_id = claims.get("sub")
+    username = claims.get("username")
+    email = claims.get("email")
+
+    # Tokens issued before the identity claims were added still need a lookup
+    if not (user_id and username and email):
+        user_id, username, email, error = fetch_identity(token)
+        if error:
+            return None, None, None, error
+
+    identity = (user_id, username, email)
+    expires_in = claims.get("exp", 0) - time.time()
+    identity_cache.set(token, (identity, claims.get("jti")), ttl=min(identity_cache.ttl, expires_in))
+    return identity + (None,)
+
+
+# Drop cached identities of a user whose account changed
+def forget_user(user_id):
+    return identity_cache.invalidate_if(lambda token, cached: cached[0][0] == user_id)
+
+
+# Follow account changes and logouts made through the user service
+def subscribe(feed):
+    feed.subscribe("user", "user", lambda event: forget_user(str(event["documentKey"]["_id"])),
+                   on_reset=identity_cache.clear)
+    revoked_tokens.subscribe(feed)
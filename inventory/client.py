@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+
+import requests
+from flask import g, has_request_context, jsonify, request
+from requests.adapters import HTTPAdapter
+
+import metrics
+import tracing
+from resilience import CircuitBreaker
+
+# Remaining request budget in milliseconds, passed on every inter-service call
+DEADLINE_HEADER = "X-Request-Budget-Ms"
+
+# Budget given to requests that arrive without a deadline header (seconds)
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "15"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+# Seconds left before the current request's deadline, or None outside a request
+def remaining_budget():
+    if not has_request_context():
+        return None
+    deadline = g.get("deadline")
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# Keep-alive client for one downstream service backed by a pooled Session
+class ServiceClient:
+    def __init__(self, name, base_url, timeout=HTTP_TIMEOUT,
+                 pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE):
+        self.name = name
+        self.base_url = (base_url or "").rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = CircuitBreaker(name)
+
+    def request(self, method, path, headers=None, timeout=None, **kwargs):
+        headers = dict(headers or {})
+        timeout = timeout or self.timeout
+
+        # Never wait longer than the caller is still willing to wait for us
+        remaining = remaining_budget()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline exceeded before calling {self.name} service")
+            timeout = min(timeout, remaining)
+            headers[DEADLINE_HEADER] = str(int(remaining * 1000))
+
+        # Fail fast while the service is known to be down or overloaded
+        self.breaker.before_call()
+
+        started = time.perf_counter()
+        status = "error"
+        with tracing.client_span(self.name, method, path) as span:
+            # Forward the request id and this call's span id
+            headers.update(span["headers"])
+            try:
+                response = self.session.request(
+                    method,
+                    f"{self.base_url}{path}",
+                    headers=headers,
+                    timeout=(min(HTTP_CONNECT_TIMEOUT, timeout), timeout),
+                    **kwargs
+                )
+                status = str(response.status_code)
+                return response
+            finally:
+                elapsed = time.perf_counter() - started
+                span["tags"]["http.status_code"] = status
+                metrics.observe_downstream(self.name, status, elapsed)
+                # Client errors are the caller's fault, not a sign of an unhealthy service
+                self.breaker.record(elapsed, failed=status == "error" or status.startswith("5"))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# One shared client per downstream service, configured from the environment:
+# <NAME>_MICROSERVICE_URL, <NAME>_HTTP_TIMEOUT and <NAME>_HTTP_POOL_MAXSIZE
+def get_client(name):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                prefix = name.upper()
+                client = ServiceClient(
+                    name,
+                    os.getenv(f"{prefix}_MICROSERVICE_URL"),
+                    timeout=float(os.getenv(f"{prefix}_HTTP_TIMEOUT", HTTP_TIMEOUT)),
+                    pool_maxsize=int(os.getenv(f"{prefix}_HTTP_POOL_MAXSIZE", HTTP_POOL_MAXSIZE)),
+                )
+                _clients[name] = client
+    return client
+
+
+def close_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+# Start each request's deadline from the caller's budget header, if any,
+# and refuse work whose caller has already given up
+def init_app(app):
+    @app.before_request
+    def start_deadline():
+        budget = REQUEST_BUDGET
+        header = request.headers.get(DEADLINE_HEADER)
+        if header:
+            try:
+                budget = min(budget, int(header) / 1000)
+            except ValueError:
+                pass
+        g.deadline = time.monotonic() + budget
+        if budget <= 0:
+            return jsonify({"msg": "Deadline exceeded"}), 504
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(e):
+        return jsonify({"msg": str(e) or "Deadline exceeded"}), 504
@@ -0,0 +1,60 @@
+import json
+from datetime import date, datetime
+
+from bson import ObjectId
+from flask import Response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+import metrics
+
+# orjson is optional; without it the stdlib encoder is used with the same output
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# Lets jsonify handle ObjectId and datetime values as well
+class JSONEncoder(FlaskJSONEncoder):
+    def default(self, obj):
+        try:
+            return _default(obj)
+        except TypeError:
+            return super().default(obj)
+
+
+# Encode to JSON bytes, with ObjectId and datetime handled natively
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+def json_response(obj, status=200, headers=None):
+    with metrics.phase("serialize"):
+        body = dumps(obj)
+    return Response(body, status=status, headers=headers, mimetype="application/json")
+
+
+# Turn a projected cursor document into an API row in place: "_id" becomes
+# "id" (encoded as a string by dumps) and missing fields become null
+def as_row(doc, fields):
+    doc["id"] = doc.pop("_id")
+    for field in fields:
+        if field not in doc:
+            doc[field] = None
+    return doc
+
+
+def init_app(app):
+    app.json_encoder = JSONEncoder
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+# Entries claimed per polling round
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "10"))
+# How long a claimed entry is reserved before another worker may retry it
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_BASE_BACKOFF = float(os.getenv("OUTBOX_BASE_BACKOFF", "2"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+
+
+# Record that the products of an inventory about to be deleted will have to
+# be removed. The entry is reserved until confirm() once the inventory is
+# gone, or dropped with cancel() if the delete did not happen. A reservation
+# left behind by a crash is picked up after OUTBOX_LEASE and only carried out
+# if the inventory no longer exists.
+def enqueue(collection, inventory_id, user_id, username, email):
+    now = datetime.utcnow()
+    result = collection.insert_one({
+        "inventory_id": inventory_id,
+        "user_id": user_id,
+        "username": username,
+        "email": email,
+        "status": "reserved",
+        "deleted": 0,
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": now + timedelta(seconds=OUTBOX_LEASE)
+    })
+    return result.inserted_id
+
+
+def confirm(collection, entry_id):
+    collection.update_one(
+        {"_id": entry_id, "status": "reserved"},
+        {"$set": {"status": "pending", "next_attempt_at": datetime.utcnow()}}
+    )
+
+
+def cancel(collection, entry_id):
+    collection.delete_one({"_id": entry_id, "status": "reserved"})
+
+
+# Drains the outbox in the background. purge(entry) removes one chunk of the
+# inventory's products and returns (deleted_count, done); it must be safe to
+# repeat, since an entry is retried from the start of a chunk after a failure.
+# exists(entry) tells whether the inventory of an unconfirmed entry is still
+# there, in which case its products are left alone.
+class OutboxWorker:
+    def __init__(self, collection, purge, exists):
+        self.collection = collection
+        self.purge = purge
+        self.exists = exists
+        self._stopped = threading.Event()
+
+    def claim(self):
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {"status": {"$in": ["reserved", "pending", "running"]}, "next_attempt_at": {"$lte": now}},
+            {"$set": {"status": "running", "next_attempt_at": now + timedelta(seconds=OUTBOX_LEASE)}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.BEFORE
+        )
+
+    def process(self, entry):
+        try:
+            if entry["status"] == "reserved" and self.exists(entry):
+                self.collection.update_one({"_id": entry["_id"]}, {
+                    "$set": {"status": "cancelled", "finished_at": datetime.utcnow()}
+                })
+                logging.info(f"Inventory {entry['inventory_id']} was not deleted, keeping its products")
+                return
+            done = False
+            while not done and not self._stopped.is_set():
+                deleted, done = self.purge(entry)
+                # Report progress and keep the lease while chunks succeed
+                self.collection.update_one({"_id": entry["_id"]}, {
+                    "$inc": {"deleted": deleted},
+                    "$set": {"next_attempt_at": datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE)}
+                })
+            if done:
+                self.collection.update_one({"_id": entry["_id"]}, {
+                    "$set": {"status": "done", "finished_at": datetime.utcnow()}
+                })
+                logging.info(f"Deleted all products of inventory {entry['inventory_id']}")
+        except Exception as e:
+            attempts = entry.get("attempts", 0) + 1
+            backoff = min(OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+            self.collection.update_one({"_id": entry["_id"]}, {"$set": {
+                "status": "pending",
+                "attempts": attempts,
+                "last_error": str(e),
+                "next_attempt_at": datetime.utcnow() + timedelta(seconds=backoff)
+            }})
+            logging.warning(f"Deleting products of inventory {entry['inventory_id']} failed "
+                            f"(attempt {attempts}), retrying in {backoff}s: {str(e)}")
+
+    def drain(self):
+        for _ in range(OUTBOX_BATCH_SIZE):
+            entry = self.claim()
+            if entry is None:
+                break
+            self.process(entry)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logging.warning(f"Outbox worker error: {str(e)}")
+            self._stopped.wait(OUTBOX_POLL_INTERVAL)
+
+    def start(self):
+        threading.Thread(target=self.run, name="outbox-worker", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,156 @@
+import base64
+import json
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Response, request, stream_with_context
+
+from fastjson import dumps, json_response
+
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+
+# Opaque token for the page after the one being returned
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+STREAM_MIMETYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+class PaginationError(ValueError):
+    pass
+
+
+# Cursors hold the sort key values of the last row, base64 encoded JSON
+def encode_cursor(doc, sort_fields):
+    values = {}
+    for field, _ in sort_fields:
+        value = doc.get(field)
+        values[field] = {"$oid": str(value)} if isinstance(value, ObjectId) else value
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(token, sort_fields):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        after = {}
+        for field, _ in sort_fields:
+            value = values[field]
+            after[field] = ObjectId(value["$oid"]) if isinstance(value, dict) else value
+        return after
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise PaginationError("Invalid 'after' cursor")
+
+
+# Read ?limit= and ?after= from the query string
+def page_params(sort_fields):
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise PaginationError("'limit' must be an integer")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise PaginationError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}")
+
+    after = request.args.get("after")
+    if after is not None:
+        after = decode_cursor(after, sort_fields)
+    return limit, after
+
+
+# Read ?fields= as a subset of the allowed fields, defaulting to all of them
+def requested_fields(allowed, default=None):
+    fields = request.args.get("fields")
+    if not fields:
+        return list(default or allowed)
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise PaginationError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+# The sort fields are always projected, since the next cursor is encoded
+# from them
+def projection(fields, sort_fields=()):
+    projected = {field: 1 for field in fields}
+    projected.update({field: 1 for field, _ in sort_fields})
+    return projected
+
+
+# Sort fields projected only for the cursor, to leave out of the rows
+def cursor_only_fields(fields, sort_fields):
+    return [field for field, _ in sort_fields if field != "_id" and field not in fields]
+
+
+# Restrict a query to rows sorted after the cursor position
+def apply_after(query, after, sort_fields):
+    if not after:
+        return query
+    clauses = []
+    for i, (field, direction) in enumerate(sort_fields):
+        clause = {prev: after[prev] for prev, _ in sort_fields[:i]}
+        clause[field] = {"$gt" if direction > 0 else "$lt": after[field]}
+        clauses.append(clause)
+    keyset = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+    return {"$and": [query, keyset]}
+
+
+# Serialize one page and remember where the next one starts
+def collect_page(cursor, serialize, sort_fields, limit):
+    docs = list(cursor)
+    next_cursor = None
+    if limit and docs and len(docs) == limit:
+        next_cursor = encode_cursor(docs[-1], sort_fields)
+    return [serialize(doc) for doc in docs], next_cursor
+
+
+def page_response(rows, next_cursor, status=200):
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return json_response(rows, status, headers)
+
+
+# ?stream=json or ?stream=ndjson, or None for a regular response
+def stream_mode():
+    mode = request.args.get("stream")
+    if mode and mode not in STREAM_MIMETYPES:
+        raise PaginationError(f"'stream' must be one of: {', '.join(STREAM_MIMETYPES)}")
+    return mode
+
+
+# Write rows straight from the cursor (or any iterable of documents) in chunks
+# instead of building the list
+def stream_response(cursor, serialize, mode):
+    if hasattr(cursor, "batch_size"):
+        cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+
+    def generate():
+        buffer = []
+        size = 0
+        if mode == "json":
+            buffer.append(b"[")
+        first = True
+        for doc in cursor:
+            line = dumps(serialize(doc))
+            if mode == "json":
+                line = line if first else b"," + line
+            else:
+                line += b"\n"
+            first = False
+            buffer.append(line)
+            size += len(line)
+            if size >= STREAM_CHUNK_SIZE:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+        if mode == "json":
+            buffer.append(b"]")
+        if buffer:
+            yield b"".join(buffer)
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[mode])
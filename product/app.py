@@ -1,12 +1,34 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_pymongo import PyMongo
 from flask_jwt_extended import JWTManager
+from flask_jwt_extended.utils import decode_token
 from bson import ObjectId
+from bson.errors import InvalidId
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import logging
+import json
 import requests
+import auth
+from auth import authenticate
+from revocation import revoked_tokens
+import client
+import resilience
+import metrics
+import tracing
+from client import DeadlineExceeded, get_client
+from resilience import CircuitOpenError
+import ownership
+import changefeed
+import fanout
+import indexes
+import pagination
+import fastjson
+import conditional
+import storage
+import transfer
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
 from urllib.parse import quote as url_quote
 
 load_dotenv()
@@ -15,91 +37,167 @@ app = Flask(__name__)
 
 # MongoDB connection configuration
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
-mongo = PyMongo(app)
+# connect=False defers connecting until first use, which keeps the client
+# fork-safe; the pool size is per worker process
+mongo = PyMongo(app, connect=False, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+                event_listeners=[metrics.mongo_listener])
 
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "123456")
 jwt = JWTManager(app)
-
-# Collection references
-products_collection = mongo.db.product
+client.init_app(app)
+resilience.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, "product")
+fastjson.init_app(app)
+ownership.init_app(app)
+# Tokens revoked by logout, read from the user service's database
+revoked_tokens.init_app(mongo.cx[changefeed.DATABASES["user"]].revoked_tokens)
+# Drop cached identities and ownership as soon as another service changes them
+auth.subscribe(changefeed.feed)
+ownership.subscribe(changefeed.feed)
+changefeed.feed.init_app(mongo.cx, mongo.db.changefeed_tokens, "product")
+
+# Product lines, stored as one document each or packed into day buckets
+# depending on PRODUCT_STORAGE
+product_store = storage.open_store(mongo.db)
+# One running buy/sell total per (user_id, inventory_id)
+rollups_collection = mongo.db.product_rollups
+
+MAX_BULK_SIZE = int(os.getenv("MAX_BULK_SIZE", "10000"))
+PURGE_CHUNK_SIZE = int(os.getenv("PURGE_CHUNK_SIZE", "1000"))
+
+indexes.init_app(app, [
+    (product_store.collection, product_store.indexes)
+])
 
 # For inter service communication between user and inventory
 def get_user_id_from_body():
-    auth_header = request.headers.get("auth-token")
-    
-    if not auth_header:
-        return None, None, None, "Token is missing"
-
-    try:
-        # Call the user microservice to get user details
-        response = requests.get(
-            f"{os.getenv('USER_MICROSERVICE_URL')}/user_id",
-            headers={"auth-token": auth_header}
-        )
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            return user_data["user_id"], user_data["username"], user_data["email"], None
-        elif response.status_code == 401:
-            return None, None, None, "Invalid token"
-        else:
-            return None, None, None, "User not found or unauthorized"
-    
-    except Exception as e:
-        return None, None, None, f"Error occurred: {str(e)}"
+    # The token is verified locally; the user service is only a fallback
+    return authenticate(request.headers.get("auth-token"))
 
+@metrics.phase("ownership")
 def check_inventory(inventory_id):
+    # Serve repeated checks from the ownership cache
+    auth_header = request.headers.get("auth-token")
+    user_id = authenticate(auth_header)[0]
+    if user_id:
+        owned = ownership.cached_ownership(user_id, inventory_id)
+        if owned is not None:
+            return owned
+
     try:
         # Call the inventory microservice to check if the inventory item exists
-        inventory_service_url = f"{os.getenv('INVENTORY_MICROSERVICE_URL')}/checkInventory/{inventory_id}"
-        auth_header = request.headers.get("auth-token")
         # Include the auth token in the headers for authentication
         headers = {"auth-token": auth_header}
-        response = requests.get(inventory_service_url, headers=headers)
+        response = get_client("inventory").get(f"/checkInventory/{inventory_id}", headers=headers)
 
         if response.status_code == 200:
             # If the inventory item exists and is owned by the user
-            return True
+            owned = True
         elif response.status_code == 403:
             # The inventory item exists but does not belong to the user
-            return False
+            owned = False
         elif response.status_code == 404:
             # The inventory item does not exist
-            return False
+            owned = False
         else:
             # Handle unexpected status codes
             raise Exception("Error checking inventory: unexpected response")
 
+        if user_id:
+            ownership.remember_ownership(user_id, inventory_id, owned)
+        return owned
+
+    except (DeadlineExceeded, CircuitOpenError):
+        raise
     except requests.exceptions.RequestException as e:
         raise Exception(f"Error occurred while contacting inventory service: {str(e)}")
 
-# For creating a product in an inventory 
-@app.route('/createProduct/<inventory_ID>', methods=['POST'])
-def create_product(inventory_ID):
-    data = request.get_json()
+def rollup_id(user_id, inventory_id):
+    return f"{user_id}:{inventory_id}"
+
+# Atomically add (sign=1) or remove (sign=-1) product lines from the rollup.
+# Every write bumps the rollup's version; its epoch is set when the rollup is
+# created, so a purged and recreated inventory never reuses old ETags.
+# Inventories without a rollup yet may already have lines, so their rollup is
+# counted from the lines instead of starting from this delta.
+def apply_to_rollup(user_id, inventory_id, products, sign=1):
+    total_buy = 0
+    total_sell = 0
+    for product in products:
+        if product.get("type") == "buy":
+            total_buy += storage.product_amount(product)
+        elif product.get("type") == "sell":
+            total_sell += storage.product_amount(product)
 
+    result = rollups_collection.update_one(
+        {"_id": rollup_id(user_id, inventory_id)},
+        {
+            "$inc": {
+                "total_buy": sign * total_buy,
+                "total_sell": sign * total_sell,
+                "count": sign * len(products),
+                "version": 1
+            }
+        }
+    )
+    if result.matched_count == 0:
+        rebuild_rollup(user_id, inventory_id)
+
+# Recompute a rollup from the product documents themselves
+def rebuild_rollup(user_id, inventory_id):
+    totals = product_store.totals(user_id, inventory_id)
+    return rollups_collection.find_one_and_update(
+        {"_id": rollup_id(user_id, inventory_id)},
+        {
+            "$set": {
+                "total_buy": totals["total_buy"],
+                "total_sell": totals["total_sell"],
+                "count": totals["count"]
+            },
+            "$inc": {"version": 1},
+            "$setOnInsert": {"user_id": user_id, "inventory_id": inventory_id, "epoch": ObjectId()}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+# Read an inventory's rollup, backfilling inventories that predate rollups
+# and rollups that predate versioning
+def read_rollup(user_id, inventory_id):
+    rollup = rollups_collection.find_one({"_id": rollup_id(user_id, inventory_id)})
+    if not rollup:
+        return rebuild_rollup(user_id, inventory_id)
+    if "epoch" not in rollup:
+        rollups_collection.update_one(
+            {"_id": rollup["_id"], "epoch": {"$exists": False}},
+            {"$set": {"epoch": ObjectId()}}
+        )
+        rollup = rollups_collection.find_one({"_id": rollup["_id"]})
+    return rollup
+
+# ETag of the current request over an inventory's products
+def products_etag(user_id, inventory_id):
+    rollup = read_rollup(user_id, inventory_id)
+    return conditional.make_etag(str(rollup["epoch"]), rollup.get("version", 0))
+
+# Returns an error message for invalid product input, None otherwise
+def validate_product(data):
     # Validate input data
-    if not data or 'name' not in data or 'price' not in data or 'quantity' not in data or 'type' not in data:
-        return jsonify({"msg": "Invalid input data. Required fields: 'name', 'price', 'quantity', 'type'."}), 400
+    if not isinstance(data, dict) or 'name' not in data or 'price' not in data or 'quantity' not in data or 'type' not in data:
+        return "Invalid input data. Required fields: 'name', 'price', 'quantity', 'type'."
 
     # Ensure the type is either 'buy' or 'sell'
     if data['type'] not in ['buy', 'sell']:
-        return jsonify({"msg": "Type must be either 'buy' or 'sell'."}), 400
+        return "Type must be either 'buy' or 'sell'."
 
-    # Get user details and validate inventory existence
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401  # Return error if user ID retrieval failed
-
-    # Check if the inventory item exists
-    if not check_inventory(inventory_ID):
-        return jsonify({"msg": "Inventory item does not exist or unauthorized."}), 404
+    return None
 
+def build_product(data, inventory_ID, user_id):
     # Set the date to current date and time if not provided
     date = data.get('date', datetime.utcnow().isoformat())
 
-    # Create a new product
-    new_product = {
+    return {
         "name": data['name'],
         "price": data['price'],
         "quantity": data['quantity'],
@@ -109,48 +207,388 @@ def create_product(inventory_ID):
         "date": date  # Use the provided date or the current date
     }
 
+# Raised to answer a request early with {"msg": msg} and the given status
+class RequestRejected(Exception):
+    def __init__(self, msg, status):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+@app.errorhandler(RequestRejected)
+def request_rejected(e):
+    return jsonify({"msg": e.msg}), e.status
+
+# Authenticate the caller and check inventory ownership at the same time.
+# Returns the user id, or raises RequestRejected with the route's own message
+# and status when the inventory is not owned.
+def authorize_inventory(inventory_ID, not_owned_msg, not_owned_status):
+    def authenticate_caller():
+        user_id, username, email, error = get_user_id_from_body()
+        if error:
+            raise RequestRejected(error, 401)
+        return user_id
+
+    def check_ownership():
+        try:
+            owned = check_inventory(inventory_ID)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # An invalid token also fails here; let authentication decide first
+            return e
+        if not owned:
+            raise RequestRejected(not_owned_msg, not_owned_status)
+        return None
+
+    user_id, ownership_error = fanout.gather(authenticate_caller, check_ownership)
+    if ownership_error:
+        raise ownership_error
+    return user_id
+
+# For creating a product in an inventory 
+@app.route('/createProduct/<inventory_ID>', methods=['POST'])
+def create_product(inventory_ID):
+    data = request.get_json()
+
+    error = validate_product(data)
+    if error:
+        return jsonify({"msg": error}), 400
+
+    # Get user details and validate inventory existence
+    user_id = authorize_inventory(inventory_ID, "Inventory item does not exist or unauthorized.", 404)
+
+    # Create a new product
+    new_product = build_product(data, inventory_ID, user_id)
+
     try:
-        result = products_collection.insert_one(new_product)
-        new_product["_id"] = str(result.inserted_id)
+        errors = product_store.insert_many([new_product])
+        if errors:
+            raise Exception(errors[0][1])
+        apply_to_rollup(user_id, inventory_ID, [new_product])
+        new_product["_id"] = str(new_product["_id"])
         return jsonify(new_product), 201
     except Exception as e:
         logging.error(f"Database error: {e}")
         return jsonify({"msg": "Failed to create product"}), 500
+
+# Read a bulk request body: a JSON array, or one JSON object per line (NDJSON)
+def read_bulk_rows():
+    if request.mimetype == "application/x-ndjson":
+        rows = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                # Keep the row so its position is reported as invalid
+                rows.append(None)
+        return rows
+
+    rows = request.get_json(silent=True)
+    return rows if isinstance(rows, list) else None
+
+# Validate and insert (row, data, parse error) rows of an inventory and add
+# them to its rollup. Returns (inserted products, errors sorted by row);
+# ordered inserts stop at the first failing row, unordered ones skip it.
+def insert_rows(rows, inventory_ID, user_id, ordered=True):
+    errors = []
+    new_products = []
+    # Row number of every product we are about to insert
+    positions = []
+    for row, data, error in rows:
+        error = error or validate_product(data)
+        if error:
+            errors.append({"row": row, "msg": error})
+            if ordered:
+                break
+            continue
+        new_products.append(build_product(data, inventory_ID, user_id))
+        positions.append(row)
+
+    inserted = new_products
+    if new_products:
+        write_errors = product_store.insert_many(new_products, ordered=ordered)
+        if write_errors:
+            failed = set()
+            for index, msg in write_errors:
+                failed.add(index)
+                errors.append({"row": positions[index], "msg": msg})
+            if ordered:
+                # Nothing after the first failed write was attempted
+                inserted = new_products[:min(failed)]
+            else:
+                inserted = [product for i, product in enumerate(new_products) if i not in failed]
+
+    if inserted:
+        apply_to_rollup(user_id, inventory_ID, inserted)
+
+    errors.sort(key=lambda error: error["row"])
+    return inserted, errors
+
+# For creating many products of an inventory in one request
+@app.route('/products/bulk/<inventory_ID>', methods=['POST'])
+def bulk_create_products(inventory_ID):
+    rows = read_bulk_rows()
+    if rows is None:
+        return jsonify({"msg": "Invalid input data. Expected a JSON array or NDJSON body of products."}), 400
+    if not rows:
+        return jsonify({"msg": "No products to create"}), 400
+    if len(rows) > MAX_BULK_SIZE:
+        return jsonify({"msg": f"At most {MAX_BULK_SIZE} products can be created per request"}), 400
+
+    # Ordered inserts stop at the first failing row, unordered ones skip it
+    ordered = request.args.get("ordered", "true").lower() != "false"
+
+    user_id = authorize_inventory(inventory_ID, "Inventory item does not exist or unauthorized.", 404)
+
+    try:
+        inserted, errors = insert_rows(((row, data, None) for row, data in enumerate(rows)), inventory_ID, user_id, ordered)
+    except Exception as e:
+        logging.error(f"Database error: {e}")
+        return jsonify({"msg": "Failed to create products"}), 500
+
+    return jsonify({
+        "inserted": len(inserted),
+        "ids": [str(product["_id"]) for product in inserted],
+        "errors": errors
+    }), 201 if not errors else 207
+
+# Import products from an NDJSON or CSV body (optionally gzip-encoded) of any
+# size. The body is spooled in full before the response starts, so clients may
+# send all of it before reading. Rows are then validated and inserted one batch
+# at a time; the NDJSON response streams a line per rejected row, a progress
+# line per batch and a final summary, so it is always 200 and the last line
+# tells how it ended.
+@app.route('/products/import/<inventory_ID>', methods=['POST'])
+def import_products(inventory_ID):
+    try:
+        fmt = transfer.import_format(request)
+    except transfer.TransferError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    user_id = authorize_inventory(inventory_ID, "Inventory item does not exist or unauthorized.", 404)
+    body = transfer.spool_body(request)
+    try:
+        rows = transfer.read_rows(transfer.open_body(body, request), fmt)
+    except transfer.TransferError as e:
+        body.close()
+        return jsonify({"msg": str(e)}), 400
+
+    def generate():
+        progress = {"rows": 0, "inserted": 0, "failed": 0}
+        try:
+            for batch in transfer.batches(rows):
+                inserted, errors = insert_rows(batch, inventory_ID, user_id, ordered=False)
+                progress["rows"] += len(batch)
+                progress["inserted"] += len(inserted)
+                progress["failed"] += len(errors)
+                lines = [fastjson.dumps(error) for error in errors]
+                lines.append(fastjson.dumps({"progress": progress}))
+                yield b"\n".join(lines) + b"\n"
+        except Exception as e:
+            logging.error(f"Import into inventory {inventory_ID} stopped: {e}")
+            yield fastjson.dumps({"msg": f"Import stopped: {str(e)}", "done": False, **progress}) + b"\n"
+            return
+        yield fastjson.dumps({"done": True, **progress}) + b"\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.call_on_close(body.close)
+    return response
+
+# For deleting many products by id in one request
+@app.route('/products/bulk_delete', methods=['POST'])
+def bulk_delete_products():
+    user_id, username, email, error = get_user_id_from_body()
+    if error:
+        return jsonify({"msg": error}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list):
+        return jsonify({"msg": "Invalid input data. Required field: 'ids'."}), 400
+    if len(data['ids']) > MAX_BULK_SIZE:
+        return jsonify({"msg": f"At most {MAX_BULK_SIZE} products can be deleted per request"}), 400
+
+    object_ids = []
+    invalid = []
+    for product_id in data['ids']:
+        try:
+            object_ids.append(ObjectId(product_id))
+        except (InvalidId, TypeError):
+            invalid.append(product_id)
+
+    # Read what is about to go so the rollups can be adjusted
+    products = product_store.find_by_ids(user_id, object_ids, ("inventory_id", "price", "quantity", "type"))
+
+    # Like the per-inventory routes, only touch inventories the caller still
+    # owns; their ownership is checked together rather than one call each
+    owned = ownership.preload_ownership(request.headers.get("auth-token"),
+                                        sorted({product["inventory_id"] for product in products}))
+    products = [product for product in products if owned.get(product["inventory_id"])]
+    found_ids = [product["_id"] for product in products]
+    deleted_count = product_store.delete_by_ids(user_id, found_ids) if found_ids else 0
+
+    by_inventory = {}
+    for product in products:
+        by_inventory.setdefault(product["inventory_id"], []).append(product)
+    for inventory_id, deleted in by_inventory.items():
+        if deleted_count == len(products):
+            apply_to_rollup(user_id, inventory_id, deleted, sign=-1)
+        else:
+            # Someone else deleted some of these lines first; recount instead
+            rebuild_rollup(user_id, inventory_id)
+
+    found = {str(product_id) for product_id in found_ids}
+    return jsonify({
+        "deleted": deleted_count,
+        "not_found": [product_id for product_id in data['ids'] if product_id not in invalid and str(product_id) not in found],
+        "invalid": invalid
+    }), 200
     
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({"msg": "Welcome to the API!"}), 200
 
 
+# Read ?from=/?to= or the ?year=/?month= shortcuts as a [start, end) range of
+# ISO date strings, which compare correctly as plain strings
+def date_range_from_args():
+    start = request.args.get("from")
+    end = request.args.get("to")
+    year = request.args.get("year")
+    month = request.args.get("month")
+
+    for value in (start, end):
+        if value is not None:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                raise ValueError("'from' and 'to' must be ISO 8601 dates")
+
+    if month is not None or year is not None:
+        try:
+            year = int(year) if year is not None else datetime.utcnow().year
+            month = int(month) if month is not None else None
+        except ValueError:
+            raise ValueError("'year' and 'month' must be integers")
+        if year < 1:
+            raise ValueError("Year must be a positive integer.")
+        if month is None:
+            start, end = f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+        elif 1 <= month <= 12:
+            start = f"{year:04d}-{month:02d}-01"
+            end = f"{year + 1:04d}-01-01" if month == 12 else f"{year:04d}-{month + 1:02d}-01"
+        else:
+            raise ValueError("Month must be between 1 and 12.")
+
+    return start, end
+
+PRODUCT_FIELDS = ("name", "price", "quantity", "type", "inventory_id")
+PRODUCT_OPTIONAL_FIELDS = ("date",)
+PRODUCT_SORT = [("date", ASCENDING), ("_id", ASCENDING)]
+PRODUCT_SORT_DESC = [("date", DESCENDING), ("_id", DESCENDING)]
+
 # For getting all product of an inventory
 @app.route('/products/<inventory_ID>', methods=['GET'])
 def get_products_by_inventory(inventory_ID):
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401
+    user_id = authorize_inventory(inventory_ID, "Unauthorized or inventory item not found", 403)
 
-    # Ensure the inventory item exists and belongs to the user
-    if not check_inventory(inventory_ID):
-        return jsonify({"msg": "Unauthorized or inventory item not found"}), 403
+    # ?sort=desc returns the newest lines first; with ?limit= that is a top-N
+    direction = request.args.get("sort", "asc")
+    if direction not in ("asc", "desc"):
+        return jsonify({"msg": "Sort must be either 'asc' or 'desc'."}), 400
+    sort = PRODUCT_SORT if direction == "asc" else PRODUCT_SORT_DESC
 
-    # Query for products associated with the specified inventory ID
-    products = products_collection.find({"inventory_id": inventory_ID, "user_id": user_id})
-    products_list = [
-        {
-            "id": str(product["_id"]),
-            "name": product["name"],
-            "price": product["price"],
-            "quantity": product["quantity"],
-            "type": product["type"],
-            "inventory_id": product["inventory_id"]
-        }
-        for product in products
-    ]
+    try:
+        fields = pagination.requested_fields(PRODUCT_FIELDS + PRODUCT_OPTIONAL_FIELDS, PRODUCT_FIELDS)
+        limit, after = pagination.page_params(sort)
+        mode = pagination.stream_mode()
+        start, end = date_range_from_args()
+    except (pagination.PaginationError, ValueError) as e:
+        return jsonify({"msg": str(e)}), 400
+
+    # Unchanged since the client's copy: answer from the rollup alone
+    etag = products_etag(user_id, inventory_ID)
+    response = conditional.not_modified(etag)
+    if response:
+        return response
+
+    # Products associated with the specified inventory ID, in sort order
+    products = product_store.find(user_id, inventory_ID, sort, fields, start, end, after, limit)
+
+    # Rows are encoded from the projected documents without copying them
+    hidden = pagination.cursor_only_fields(fields, sort)
 
-    if not products_list:
+    def serialize(product):
+        for field in hidden:
+            product.pop(field, None)
+        return fastjson.as_row(product, fields)
+
+    if mode:
+        return conditional.tagged(pagination.stream_response(products, serialize, mode), etag)
+
+    products_list, next_cursor = pagination.collect_page(products, serialize, sort, limit)
+
+    if not products_list and not after:
         return jsonify({"msg": "No products found for this inventory"}), 404
 
-    return jsonify(products_list), 200
+    return conditional.tagged(pagination.page_response(products_list, next_cursor), etag)
+
+# Export the products of an inventory as NDJSON or CSV, streamed from the
+# projected cursor in chunks and gzip-compressed with ?gzip=1. Takes the same
+# ?fields=, ?sort= and date range parameters as the listing.
+@app.route('/products/export/<inventory_ID>', methods=['GET'])
+def export_products(inventory_ID):
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in transfer.EXPORT_MIMETYPES:
+        return jsonify({"msg": f"Format must be one of: {', '.join(transfer.EXPORT_MIMETYPES)}."}), 400
+    direction = request.args.get("sort", "asc")
+    if direction not in ("asc", "desc"):
+        return jsonify({"msg": "Sort must be either 'asc' or 'desc'."}), 400
+    sort = PRODUCT_SORT if direction == "asc" else PRODUCT_SORT_DESC
+    try:
+        fields = pagination.requested_fields(PRODUCT_FIELDS + PRODUCT_OPTIONAL_FIELDS)
+        start, end = date_range_from_args()
+    except (pagination.PaginationError, ValueError) as e:
+        return jsonify({"msg": str(e)}), 400
+
+    user_id = authorize_inventory(inventory_ID, "Unauthorized or inventory item not found", 403)
+
+    products = product_store.find(user_id, inventory_ID, sort, fields, start, end)
+    hidden = pagination.cursor_only_fields(fields, sort)
+
+    def serialize(product):
+        for field in hidden:
+            product.pop(field, None)
+        return fastjson.as_row(product, fields)
+
+    chunks = transfer.encode_rows(products, serialize, fmt, ["id"] + fields)
+    headers = {"Content-Disposition": f'attachment; filename="products-{inventory_ID}.{fmt}"'}
+    if request.args.get("gzip") in ("1", "true"):
+        chunks = transfer.gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype=transfer.EXPORT_MIMETYPES[fmt], headers=headers)
+
+# Buy/sell totals and counts of an inventory grouped by month, week or day
+@app.route('/products/timeseries/<inventory_ID>', methods=['GET'])
+def get_products_timeseries(inventory_ID):
+    granularity = request.args.get("granularity", "month")
+    if granularity not in storage.GRANULARITIES:
+        return jsonify({"msg": f"Granularity must be one of: {', '.join(storage.GRANULARITIES)}."}), 400
+    try:
+        start, end = date_range_from_args()
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    user_id = authorize_inventory(inventory_ID, "Unauthorized or inventory item not found", 403)
+
+    etag = products_etag(user_id, inventory_ID)
+    response = conditional.not_modified(etag)
+    if response:
+        return response
+
+    rows = product_store.timeseries(user_id, inventory_ID, granularity, start, end)
+    return conditional.tagged(fastjson.json_response(rows), etag)
 
 # For deleting the product
 @app.route('/deleteProduct/<product_id>', methods=['DELETE'])
@@ -161,14 +599,15 @@ def delete_product(product_id):
         return jsonify({"msg": error}), 401
 
     # Find the product and ensure it belongs to the requesting user
-    product = products_collection.find_one({"_id": ObjectId(product_id), "user_id": user_id})
+    found = product_store.find_by_ids(user_id, [ObjectId(product_id)], ("inventory_id", "price", "quantity", "type"))
     
-    if not product:
+    if not found:
         return jsonify({"msg": "Product not found or unauthorized"}), 404
+    product = found[0]
 
     # Delete the product
-    result = products_collection.delete_one({"_id": ObjectId(product_id), "user_id": user_id})
-    if result.deleted_count == 1:
+    if product_store.delete_by_ids(user_id, [product["_id"]]) == 1:
+        apply_to_rollup(user_id, product["inventory_id"], [product], sign=-1)
         return jsonify({"msg": "Product deleted successfully"}), 200
     else:
         return jsonify({"msg": "Failed to delete product"}), 500
@@ -176,56 +615,89 @@ def delete_product(product_id):
 @app.route('/products/summary/<inventory_ID>', methods=['GET'])
 def get_spending_summary(inventory_ID):
     # Get the user ID from the authorization token
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401
-    if not check_inventory(inventory_ID):
-        return jsonify({"msg": "Inventory item does not exist or unauthorized."}), 404
-
-    # Retrieve all products for the user that belong to the specified inventory
-    products = products_collection.find({"user_id": user_id, "inventory_id": inventory_ID})
-
-    total_buy = 0
-    total_sell = 0
+    user_id = authorize_inventory(inventory_ID, "Inventory item does not exist or unauthorized.", 404)
 
-    # Calculate total spending on 'buy' and 'sell' type products
-    for product in products:
-        price = product.get("price", 0)
-        quantity = product.get("quantity", 0)
-        type_ = product.get("type")
+    # Read the running totals; inventories that predate rollups are backfilled once
+    rollup = read_rollup(user_id, inventory_ID)
+    etag = conditional.make_etag(str(rollup["epoch"]), rollup.get("version", 0))
+    response = conditional.not_modified(etag)
+    if response:
+        return response
 
-        if type_ == "buy":
-            total_buy += price * quantity
-        elif type_ == "sell":
-            total_sell += price * quantity
+    total_buy = rollup.get("total_buy", 0)
+    total_sell = rollup.get("total_sell", 0)
 
     # Calculate total profit (revenue from sells minus cost of buys)
     total_profit = total_sell - total_buy
 
-    return jsonify({
+    return conditional.tagged(jsonify({
         "total_buy": total_buy,
         "total_sell": total_sell,
-        "total_profit": total_profit
+        "total_profit": total_profit,
+        "count": rollup.get("count", 0)
+    }), etag)
+
+# Recompute the summary rollup of an inventory from its products
+@app.route('/admin/rollups/rebuild/<inventory_ID>', methods=['POST'])
+def rebuild_spending_summary(inventory_ID):
+    user_id = authorize_inventory(inventory_ID, "Inventory item does not exist or unauthorized.", 404)
+
+    rollup = rebuild_rollup(user_id, inventory_ID)
+    return jsonify({
+        "inventory_id": inventory_ID,
+        "total_buy": rollup["total_buy"],
+        "total_sell": rollup["total_sell"],
+        "count": rollup["count"]
     }), 200
 
 @app.route('/products/delete_all/<inventory_ID>', methods=['GET'])
 def delete_all_products(inventory_ID):
-    user_id, username, email, error = get_user_id_from_body()
-    if error:
-        return jsonify({"msg": error}), 401
-
-    inventory_exists = check_inventory(inventory_ID)
-    if not inventory_exists:
-        return jsonify({"msg": "Inventory not found or unauthorized access"}), 404
-
-    result = products_collection.delete_many({"user_id": user_id, "inventory_id": inventory_ID})
-    print(result)
-    if result.deleted_count > 0:
-        return jsonify({"msg": f"Deleted {result.deleted_count} products from inventory {inventory_ID}"}), 200
+    user_id = authorize_inventory(inventory_ID, "Inventory not found or unauthorized access", 404)
+
+    deleted_count = product_store.delete_inventory(user_id, inventory_ID)
+    logging.info(f"Deleted {deleted_count} products from inventory {inventory_ID}")
+    # The deleted lines are unknown here, so recount whatever is left
+    rebuild_rollup(user_id, inventory_ID)
+    if deleted_count > 0:
+        return jsonify({"msg": f"Deleted {deleted_count} products from inventory {inventory_ID}"}), 200
     else:
         return jsonify({"msg": "No products found for the specified inventory or unauthorized access"}), 404
 
+# Used by the inventory service's outbox worker to delete the products of an
+# already deleted inventory, one chunk per call. Safe to repeat.
+@app.route('/internal/products/purge/<inventory_ID>', methods=['POST'])
+def purge_inventory_products(inventory_ID):
+    try:
+        claims = decode_token(request.headers.get("auth-token"))
+    except Exception:
+        return jsonify({"msg": "Invalid token"}), 401
+    if claims.get("svc") != "inventory":
+        return jsonify({"msg": "Only the inventory service may purge products"}), 403
+    user_id = claims["sub"]
+
+    data = request.get_json(silent=True) or {}
+    limit = data.get("limit", PURGE_CHUNK_SIZE)
+    if not isinstance(limit, int) or limit < 1:
+        return jsonify({"msg": "'limit' must be a positive integer"}), 400
+
+    # The inventory no longer exists, so no ownership check is possible
+    ownership.invalidate_inventory(inventory_ID)
+
+    deleted, done = product_store.purge(user_id, inventory_ID, limit)
+    if done:
+        rollups_collection.delete_one({"_id": rollup_id(user_id, inventory_ID)})
+
+    return jsonify({"deleted": deleted, "done": done}), 200
+
+
+# Release pooled connections when a worker stops
+def shutdown():
+    changefeed.feed.stop()
+    client.close_clients()
+    fanout.shutdown()
+    mongo.cx.close()
 
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(host="0.0.0.0",debug=True, port=5002)
+    app.run(host="0.0.0.0", port=5002, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from flask import copy_current_request_context, g, has_request_context
+
+from client import DeadlineExceeded, remaining_budget
+
+# Shared, bounded pool for independent downstream calls made while serving a request
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "16"))
+executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+# Run fn in a pool thread with the current request and its g values
+def bind_request(fn):
+    if not has_request_context():
+        return fn
+    values = {key: g.get(key) for key in g}
+
+    @copy_current_request_context
+    def run():
+        for key, value in values.items():
+            setattr(g, key, value)
+        return fn()
+
+    return run
+
+
+# Start callables in the pool now and return their futures
+def submit(*calls):
+    return [executor.submit(bind_request(call)) for call in calls]
+
+
+# Run callables concurrently and return their results in order. The first
+# failure is raised and the calls that have not started yet are cancelled;
+# calls already in flight are bounded by their own HTTP timeouts.
+def gather(*calls, timeout=None):
+    if timeout is None:
+        timeout = remaining_budget()
+    futures = submit(*calls)
+    done, pending = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+
+    for future in futures:
+        if future in done and future.exception() is not None:
+            for sibling in pending:
+                sibling.cancel()
+            raise future.exception()
+
+    if pending:
+        for sibling in pending:
+            sibling.cancel()
+        raise DeadlineExceeded("Deadline exceeded waiting for downstream services")
+
+    return [future.result() for future in futures]
+
+
+# Wait for submitted calls and return [(result, error)] in order without
+# raising. Calls still running after timeout get a DeadlineExceeded error and
+# are left to finish in the background, bounded by their own HTTP timeouts.
+def settle(futures, timeout=None):
+    if timeout is None:
+        timeout = remaining_budget()
+    wait(futures, timeout=timeout)
+
+    outcomes = []
+    for future in futures:
+        if not future.done():
+            future.cancel()
+            outcomes.append((None, DeadlineExceeded("Deadline exceeded waiting for downstream service")))
+        elif future.exception() is not None:
+            outcomes.append((None, future.exception()))
+        else:
+            outcomes.append((future.result(), None))
+    return outcomes
+
+
+def shutdown():
+    executor.shutdown(wait=False)
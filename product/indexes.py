@@ -0,0 +1,53 @@
+import logging
+import os
+import threading
+
+from flask import jsonify
+from pymongo.errors import PyMongoError
+
+# "<collection>.<index name>" -> {"state": "pending" | "building" | "ready" | "failed", ...}
+index_status = {}
+_status_lock = threading.Lock()
+
+
+def _set_status(key, state, error=None):
+    with _status_lock:
+        index_status[key] = {"state": state} if error is None else {"state": state, "error": error}
+
+
+def index_ready(collection_name, index_name):
+    return index_status.get(f"{collection_name}.{index_name}", {}).get("state") == "ready"
+
+
+# specs is a list of (collection, [IndexModel, ...]); every IndexModel needs a name
+def ensure_indexes(specs):
+    for collection, models in specs:
+        for model in models:
+            _set_status(f"{collection.name}.{model.document['name']}", "pending")
+
+    for collection, models in specs:
+        for model in models:
+            key = f"{collection.name}.{model.document['name']}"
+            _set_status(key, "building")
+            try:
+                collection.create_indexes([model])
+                _set_status(key, "ready")
+                logging.info(f"Index {key} is ready")
+            except PyMongoError as e:
+                _set_status(key, "failed", str(e))
+                logging.error(f"Failed to build index {key}: {str(e)}")
+    return index_status
+
+
+# Build the declared indexes in the background so startup is not blocked
+# by a slow or unreachable database, and report their state at /admin/indexes
+def init_app(app, specs):
+    @app.route('/admin/indexes', methods=['GET'])
+    def get_index_status():
+        with _status_lock:
+            status = dict(index_status)
+        ready = bool(status) and all(entry["state"] == "ready" for entry in status.values())
+        return jsonify({"ready": ready, "indexes": status}), 200
+
+    if os.getenv("ENSURE_INDEXES", "1") == "1":
+        threading.Thread(target=ensure_indexes, args=(specs,), name="ensure-indexes", daemon=True).start()
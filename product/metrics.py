@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from pymongo import monitoring
+
+# Latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._values.items():
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {series[i]}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-2]}")
+        return lines
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests served", ("method", "route", "status"))
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time spent serving HTTP requests",
+                             ("method", "route", "status"))
+PHASE_DURATION = Histogram("http_request_phase_duration_seconds",
+                           "Time spent per request in each phase (auth, ownership, http_<service>, mongo, serialize)",
+                           ("route", "phase"))
+DOWNSTREAM_DURATION = Histogram("downstream_request_duration_seconds", "Inter-service HTTP calls",
+                                ("service", "status"))
+MONGO_DURATION = Histogram("mongo_command_duration_seconds", "PyMongo commands", ("command", "status"))
+
+CIRCUIT_TRANSITIONS = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes",
+                              ("service", "state"))
+CIRCUIT_REJECTIONS = Counter("circuit_breaker_rejections_total", "Calls refused by an open circuit", ("service",))
+SHED_REQUESTS = Counter("http_requests_shed_total", "Requests rejected by the concurrency limit")
+
+REGISTRY = [REQUESTS, REQUEST_DURATION, PHASE_DURATION, DOWNSTREAM_DURATION, MONGO_DURATION,
+            CIRCUIT_TRANSITIONS, CIRCUIT_REJECTIONS, SHED_REQUESTS]
+
+
+# Add time to a phase of the current request; phases may nest, e.g. the
+# ownership phase includes its http_inventory call
+def record_phase(name, seconds):
+    if not has_request_context():
+        return
+    phases = g.get("phases")
+    if phases is not None:
+        phases[name] = phases.get(name, 0) + seconds
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def observe_downstream(service, status, seconds):
+    DOWNSTREAM_DURATION.observe(seconds, service=service, status=status)
+    record_phase(f"http_{service}", seconds)
+
+
+# Times every PyMongo command; events arrive on the thread that ran the command
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_DURATION.observe(seconds, command=event.command_name, status="ok")
+        record_phase("mongo", seconds)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_DURATION.observe(seconds, command=event.command_name, status="error")
+        record_phase("mongo", seconds)
+
+
+mongo_listener = MongoCommandListener()
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Each gunicorn worker keeps its own series; Prometheus should scrape workers
+# individually or the numbers be read as per-process samples
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.phases = {}
+
+    @app.after_request
+    def record_request(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        status = str(response.status_code)
+        REQUESTS.inc(method=request.method, route=route, status=status)
+        REQUEST_DURATION.observe(seconds, method=request.method, route=route, status=status)
+
+        phases = g.get("phases") or {}
+        for name, phase_seconds in phases.items():
+            PHASE_DURATION.observe(phase_seconds, route=route, phase=name)
+        timings = [f"{name};dur={phase_seconds * 1000:.1f}" for name, phase_seconds in phases.items()]
+        timings.append(f"total;dur={seconds * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(timings)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
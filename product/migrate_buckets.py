@@ -0,0 +1,128 @@
+# Copy the one-document-per-line product collection into day buckets while
+# the service keeps running on PRODUCT_STORAGE=documents.
+#
+#   python migrate_buckets.py            # copy everything, resumable
+#   python migrate_buckets.py --catch-up # after switching to buckets
+#
+# Lines keep their _id, so the copy is idempotent and resumes from the last
+# copied _id stored in the migrations collection. Once it has finished,
+# restart the service with PRODUCT_STORAGE=buckets and run --catch-up: it
+# copies the lines written while the copy was running and removes the ones
+# deleted from the documents meanwhile. Keep the documents collection until
+# the catch-up has finished; drop it afterwards.
+import argparse
+import logging
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, MongoClient
+
+import storage
+
+MIGRATION_ID = "product_buckets"
+
+
+def copy_batch(buckets, batch):
+    ids = [product["_id"] for product in batch]
+    # Lines copied by an earlier, interrupted run are skipped
+    copied = set()
+    for bucket in buckets.collection.find({"lines._id": {"$in": ids}}, {"lines._id": 1}):
+        copied.update(line["_id"] for line in bucket["lines"])
+    pending = [product for product in batch if product["_id"] not in copied]
+    if pending:
+        errors = buckets.insert_many(pending)
+        if errors:
+            raise RuntimeError(f"Failed to copy {len(errors)} lines: {errors[0][1]}")
+    return len(pending)
+
+
+def copy(db, batch_size):
+    documents = storage.DocumentStore(db)
+    buckets = storage.BucketStore(db)
+    migrations = db.migrations
+
+    state = migrations.find_one({"_id": MIGRATION_ID}) or {}
+    last_id = state.get("last_id")
+    total = state.get("copied", 0)
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = list(documents.collection.find(query).sort("_id", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        total += copy_batch(buckets, batch)
+        last_id = batch[-1]["_id"]
+        migrations.update_one(
+            {"_id": MIGRATION_ID},
+            {"$set": {"last_id": last_id, "copied": total, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        logging.info(f"Copied {total} product lines, up to {last_id}")
+    return total
+
+
+# Drop bucket lines whose documents were deleted while the copy was running.
+# Only copied lines are considered: lines written since the switch to buckets
+# have no document, and their newer ObjectIds sort after the last copied one.
+#
+# This reads every bucket once and looks up its copied lines in the documents
+# collection by _id, so it costs one indexed $in query per bucket and reads
+# every line. Progress is checkpointed by bucket _id, so an interrupted run
+# resumes where it stopped; a finished run clears the checkpoint so the next
+# one starts over.
+def remove_deleted(db, batch_size):
+    documents = storage.DocumentStore(db)
+    buckets = storage.BucketStore(db)
+    migrations = db.migrations
+    state = migrations.find_one({"_id": MIGRATION_ID}) or {}
+    last_id = state.get("last_id")
+    if last_id is None:
+        return 0
+    last_bucket_id = state.get("removed_through")
+    removed = state.get("removed", 0) if last_bucket_id else 0
+    query = {"_id": {"$gt": last_bucket_id}} if last_bucket_id else {}
+    scanned = 0
+    cursor = buckets.collection.find(query, {"user_id": 1, "lines._id": 1}).sort("_id", ASCENDING)
+    for bucket in cursor.batch_size(batch_size):
+        ids = [line["_id"] for line in bucket.get("lines", []) if line["_id"] <= last_id]
+        if ids:
+            present = {product["_id"] for product in documents.collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+            missing = [line_id for line_id in ids if line_id not in present]
+            if missing:
+                removed += buckets.delete_by_ids(bucket["user_id"], missing)
+        scanned += 1
+        if scanned % batch_size == 0:
+            migrations.update_one({"_id": MIGRATION_ID}, {"$set": {
+                "removed_through": bucket["_id"], "removed": removed, "updated_at": datetime.utcnow()
+            }})
+            logging.info(f"Checked {scanned} buckets, removed {removed} deleted product lines")
+    migrations.update_one({"_id": MIGRATION_ID}, {
+        "$set": {"removed": removed, "updated_at": datetime.utcnow()},
+        "$unset": {"removed_through": ""}
+    })
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate product lines into day buckets")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--catch-up", action="store_true",
+                        help="copy new lines and remove deleted ones after the service uses buckets")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoClient(args.mongo_uri).get_default_database()
+    buckets = storage.BucketStore(db)
+    buckets.collection.create_indexes(buckets.indexes)
+
+    copied = copy(db, args.batch_size)
+    logging.info(f"Copy finished: {copied} product lines in buckets")
+    if args.catch_up:
+        removed = remove_deleted(db, args.batch_size)
+        logging.info(f"Catch-up finished: removed {removed} deleted product lines")
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main()
@@ -0,0 +1,387 @@
+import os
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from pagination import apply_after, projection
+
+# "documents" keeps one document per product line, "buckets" packs the lines
+# of an inventory into per-day bucket documents with precomputed totals
+PRODUCT_STORAGE = os.getenv("PRODUCT_STORAGE", "documents")
+# Lines per bucket document; a busy day spills over into further buckets
+PRODUCT_BUCKET_SIZE = int(os.getenv("PRODUCT_BUCKET_SIZE", "500"))
+
+GRANULARITIES = ("month", "day", "week")
+
+
+# Bucket key expression over an ISO 8601 date string field
+def timeseries_key(granularity, field="$date"):
+    if granularity == "month":
+        return {"$substr": [field, 0, 7]}
+    if granularity == "day":
+        return {"$substr": [field, 0, 10]}
+    return {"$dateToString": {
+        "format": "%G-W%V",
+        "date": {"$dateFromString": {
+            "dateString": {"$substr": [field, 0, 10]},
+            "format": "%Y-%m-%d",
+            "onError": None
+        }}
+    }}
+
+
+# Value of a product line; lines without a numeric price or quantity count as
+# 0, the same rule as product_amount
+LINE_VALUE = {"$cond": [
+    {"$and": [{"$isNumber": "$price"}, {"$isNumber": "$quantity"}]},
+    {"$multiply": ["$price", "$quantity"]},
+    0
+]}
+
+
+# Buy/sell totals and counts of product lines grouped by key
+def group_lines(key):
+    is_buy = {"$eq": ["$type", "buy"]}
+    is_sell = {"$eq": ["$type", "sell"]}
+    return {"$group": {
+        "_id": key,
+        "total_buy": {"$sum": {"$cond": [is_buy, LINE_VALUE, 0]}},
+        "total_sell": {"$sum": {"$cond": [is_sell, LINE_VALUE, 0]}},
+        "buy_count": {"$sum": {"$cond": [is_buy, 1, 0]}},
+        "sell_count": {"$sum": {"$cond": [is_sell, 1, 0]}},
+        "count": {"$sum": 1}
+    }}
+
+
+def date_filter(start, end, field="date"):
+    bounds = {}
+    if start is not None:
+        bounds["$gte"] = start
+    if end is not None:
+        bounds["$lt"] = end
+    return {field: bounds} if bounds else {}
+
+
+def timeseries_rows(buckets):
+    rows = []
+    for bucket in buckets:
+        bucket["bucket"] = bucket.pop("_id")
+        rows.append(bucket)
+    return rows
+
+
+# Value of a product line, ignoring lines without a numeric price or quantity.
+# Keep in line with LINE_VALUE.
+def product_amount(product):
+    price = product.get("price", 0)
+    quantity = product.get("quantity", 0)
+    if isinstance(price, bool) or isinstance(quantity, bool):
+        return 0
+    if not isinstance(price, (int, float)) or not isinstance(quantity, (int, float)):
+        return 0
+    return price * quantity
+
+
+# One document per product line
+class DocumentStore:
+    def __init__(self, db):
+        self.collection = db.product
+        self.indexes = [
+            # _id breaks ties between lines with the same date for keyset pagination
+            IndexModel([("user_id", ASCENDING), ("inventory_id", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)],
+                       name="user_inventory_date_id")
+        ]
+
+    # Insert products, setting their _id. Returns [(position, message)] of the
+    # rows that failed; ordered inserts stop at the first failure.
+    def insert_many(self, products, ordered=True):
+        try:
+            self.collection.insert_many(products, ordered=ordered)
+        except BulkWriteError as e:
+            return [(error["index"], error.get("errmsg", "Write failed")) for error in e.details.get("writeErrors", [])]
+        return []
+
+    # Lines of an inventory in sort order, within [start, end) and after the
+    # keyset cursor position
+    def find(self, user_id, inventory_id, sort, fields, start=None, end=None, after=None, limit=None):
+        query = {"user_id": user_id, "inventory_id": inventory_id}
+        query.update(date_filter(start, end))
+        query = apply_after(query, after, sort)
+        cursor = self.collection.find(query, projection(fields, sort)).sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def find_by_ids(self, user_id, ids, fields):
+        return list(self.collection.find({"_id": {"$in": ids}, "user_id": user_id}, {field: 1 for field in fields}))
+
+    def delete_by_ids(self, user_id, ids):
+        return self.collection.delete_many({"_id": {"$in": ids}, "user_id": user_id}).deleted_count
+
+    def delete_inventory(self, user_id, inventory_id):
+        return self.collection.delete_many({"user_id": user_id, "inventory_id": inventory_id}).deleted_count
+
+    # Delete up to limit lines of an inventory; returns (deleted, done)
+    def purge(self, user_id, inventory_id, limit):
+        query = {"user_id": user_id, "inventory_id": inventory_id}
+        ids = [product["_id"] for product in self.collection.find(query, {"_id": 1}).limit(limit)]
+        deleted = self.collection.delete_many({"_id": {"$in": ids}}).deleted_count if ids else 0
+        return deleted, len(ids) < limit
+
+    def totals(self, user_id, inventory_id):
+        totals = list(self.collection.aggregate([
+            {"$match": {"user_id": user_id, "inventory_id": inventory_id}},
+            group_lines(None)
+        ]))
+        return totals[0] if totals else {"total_buy": 0, "total_sell": 0, "count": 0}
+
+    def timeseries(self, user_id, inventory_id, granularity, start=None, end=None):
+        query = {"user_id": user_id, "inventory_id": inventory_id}
+        query.update(date_filter(start, end))
+        return timeseries_rows(self.collection.aggregate([
+            {"$match": query},
+            group_lines(timeseries_key(granularity)),
+            {"$sort": {"_id": 1}}
+        ]))
+
+
+# Lines of one inventory and day, up to PRODUCT_BUCKET_SIZE per document:
+#   {user_id, inventory_id, day, first, last, lines: [...], count,
+#    total_buy, total_sell, buy_count, sell_count}
+# first/last bound the dates of the lines, so buckets entirely inside a date
+# range are summed from their totals without reading their lines.
+class BucketStore:
+    def __init__(self, db, bucket_size=PRODUCT_BUCKET_SIZE):
+        self.collection = db.product_buckets
+        self.bucket_size = bucket_size
+        self.indexes = [
+            IndexModel([("user_id", ASCENDING), ("inventory_id", ASCENDING), ("day", ASCENDING), ("_id", ASCENDING)],
+                       name="user_inventory_day_id"),
+            IndexModel([("lines._id", ASCENDING)], name="lines_id")
+        ]
+
+    def _push(self, user_id, inventory_id, product):
+        line = {key: value for key, value in product.items() if key not in ("user_id", "inventory_id")}
+        date = str(line.get("date", ""))
+        amount = product_amount(line)
+        is_buy = line.get("type") == "buy"
+        is_sell = line.get("type") == "sell"
+        # The count bound is ignored when upserting, so a full bucket makes
+        # the update insert the next one
+        return UpdateOne(
+            {"user_id": user_id, "inventory_id": inventory_id, "day": date[:10], "count": {"$lt": self.bucket_size}},
+            {
+                "$push": {"lines": line},
+                "$inc": {
+                    "count": 1,
+                    "total_buy": amount if is_buy else 0,
+                    "total_sell": amount if is_sell else 0,
+                    "buy_count": 1 if is_buy else 0,
+                    "sell_count": 1 if is_sell else 0
+                },
+                "$min": {"first": date},
+                "$max": {"last": date}
+            },
+            upsert=True
+        )
+
+    def insert_many(self, products, ordered=True):
+        for product in products:
+            product.setdefault("_id", ObjectId())
+        updates = [self._push(product["user_id"], product["inventory_id"], product) for product in products]
+        try:
+            self.collection.bulk_write(updates, ordered=ordered)
+        except BulkWriteError as e:
+            return [(error["index"], error.get("errmsg", "Write failed")) for error in e.details.get("writeErrors", [])]
+        return []
+
+    # Buckets holding lines of an inventory within [start, end)
+    def _bucket_query(self, user_id, inventory_id, start=None, end=None, *conditions):
+        clauses = [{"user_id": user_id, "inventory_id": inventory_id}]
+        if start is not None:
+            clauses.append({"day": {"$gte": start[:10]}, "last": {"$gte": start}})
+        if end is not None:
+            clauses.append({"day": {"$lte": end[:10]}, "first": {"$lt": end}})
+        clauses.extend(conditions)
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def find(self, user_id, inventory_id, sort, fields, start=None, end=None, after=None, limit=None):
+        direction = sort[0][1]
+        descending = direction == DESCENDING
+        sort_fields = [field for field, _ in sort]
+        conditions = []
+        if after:
+            # Skip whole days on the far side of the cursor
+            conditions.append({"day": {"$lte" if descending else "$gte": str(after["date"])[:10]}})
+        query = self._bucket_query(user_id, inventory_id, start, end, *conditions)
+        projection = {"day": 1}
+        projection.update({f"lines.{field}": 1 for field in set(fields) | set(sort_fields)})
+        buckets = self.collection.find(query, projection).sort([("day", direction), ("_id", direction)])
+
+        def key(line):
+            return tuple(str(line.get(field, "")) if field == "date" else line.get(field) for field in sort_fields)
+
+        after_key = key(after) if after else None
+        # Lines do not store the ids their bucket holds; add back the requested ones
+        context = {field: value for field, value in (("user_id", user_id), ("inventory_id", inventory_id))
+                   if field in fields}
+
+        def matches(line):
+            date = str(line.get("date", ""))
+            if start is not None and date < start:
+                return False
+            if end is not None and date >= end:
+                return False
+            if after_key is not None:
+                return key(line) < after_key if descending else key(line) > after_key
+            return True
+
+        # Lines of one day may be spread over several buckets, so each day is
+        # sorted as a whole before any of it is returned
+        def generate():
+            returned = 0
+            day, lines = None, []
+            for bucket in buckets:
+                if bucket["day"] != day:
+                    for line in sorted(lines, key=key, reverse=descending):
+                        yield line
+                        returned += 1
+                        if limit and returned >= limit:
+                            return
+                    day, lines = bucket["day"], []
+                for line in bucket.get("lines", []):
+                    if matches(line):
+                        line.update(context)
+                        lines.append(line)
+            for line in sorted(lines, key=key, reverse=descending):
+                yield line
+                returned += 1
+                if limit and returned >= limit:
+                    return
+
+        return generate()
+
+    def find_by_ids(self, user_id, ids, fields):
+        wanted = set(ids)
+        products = []
+        for bucket in self.collection.find({"user_id": user_id, "lines._id": {"$in": ids}},
+                                           {"inventory_id": 1, "lines": 1}):
+            for line in bucket["lines"]:
+                if line["_id"] in wanted:
+                    line["user_id"] = user_id
+                    line["inventory_id"] = bucket["inventory_id"]
+                    products.append(line)
+        return products
+
+    def _pull(self, bucket_id, lines):
+        amounts = {"count": -len(lines), "total_buy": 0, "total_sell": 0, "buy_count": 0, "sell_count": 0}
+        for line in lines:
+            if line.get("type") == "buy":
+                amounts["total_buy"] -= product_amount(line)
+                amounts["buy_count"] -= 1
+            elif line.get("type") == "sell":
+                amounts["total_sell"] -= product_amount(line)
+                amounts["sell_count"] -= 1
+        ids = [line["_id"] for line in lines]
+        # Only applies if every line is still there, so totals are never
+        # decremented twice for the same line
+        result = self.collection.update_one(
+            {"_id": bucket_id, "lines._id": {"$all": ids}},
+            {"$pull": {"lines": {"_id": {"$in": ids}}}, "$inc": amounts}
+        )
+        return result.modified_count == 1
+
+    def delete_by_ids(self, user_id, ids):
+        wanted = set(ids)
+        deleted = 0
+        for bucket in self.collection.find({"user_id": user_id, "lines._id": {"$in": ids}}, {"lines": 1}):
+            lines = [line for line in bucket["lines"] if line["_id"] in wanted]
+            if self._pull(bucket["_id"], lines):
+                deleted += len(lines)
+            else:
+                # Someone else removed some of these lines first; go one by one
+                deleted += sum(1 for line in lines if self._pull(bucket["_id"], [line]))
+            self.collection.delete_one({"_id": bucket["_id"], "count": 0})
+        return deleted
+
+    def _delete_buckets(self, buckets):
+        ids = [bucket["_id"] for bucket in buckets]
+        if not ids:
+            return 0
+        self.collection.delete_many({"_id": {"$in": ids}})
+        return sum(bucket.get("count", 0) for bucket in buckets)
+
+    def delete_inventory(self, user_id, inventory_id):
+        buckets = list(self.collection.find({"user_id": user_id, "inventory_id": inventory_id}, {"count": 1}))
+        return self._delete_buckets(buckets)
+
+    # Whole buckets are deleted until at least limit lines are gone
+    def purge(self, user_id, inventory_id, limit):
+        buckets = []
+        lines = 0
+        for bucket in self.collection.find({"user_id": user_id, "inventory_id": inventory_id}, {"count": 1}):
+            if lines >= limit:
+                return self._delete_buckets(buckets), False
+            buckets.append(bucket)
+            lines += bucket.get("count", 0)
+        return self._delete_buckets(buckets), True
+
+    def totals(self, user_id, inventory_id):
+        totals = list(self.collection.aggregate([
+            {"$match": {"user_id": user_id, "inventory_id": inventory_id}},
+            {"$group": {
+                "_id": None,
+                "total_buy": {"$sum": "$total_buy"},
+                "total_sell": {"$sum": "$total_sell"},
+                "count": {"$sum": "$count"}
+            }}
+        ]))
+        return totals[0] if totals else {"total_buy": 0, "total_sell": 0, "count": 0}
+
+    def timeseries(self, user_id, inventory_id, granularity, start=None, end=None):
+        inside = {}
+        if start is not None:
+            inside["first"] = {"$gte": start}
+        if end is not None:
+            inside["last"] = {"$lt": end}
+
+        # Buckets entirely inside the range contribute their totals...
+        rows = {}
+        for row in self.collection.aggregate([
+            {"$match": self._bucket_query(user_id, inventory_id, start, end, inside)},
+            {"$group": {
+                "_id": timeseries_key(granularity, "$day"),
+                "total_buy": {"$sum": "$total_buy"},
+                "total_sell": {"$sum": "$total_sell"},
+                "buy_count": {"$sum": "$buy_count"},
+                "sell_count": {"$sum": "$sell_count"},
+                "count": {"$sum": "$count"}
+            }}
+        ]):
+            rows[row["_id"]] = row
+
+        # ...and only the lines of buckets straddling a bound are read
+        if inside:
+            for row in self.collection.aggregate([
+                {"$match": self._bucket_query(user_id, inventory_id, start, end, {"$nor": [inside]})},
+                {"$unwind": "$lines"},
+                {"$replaceRoot": {"newRoot": "$lines"}},
+                {"$match": date_filter(start, end)},
+                group_lines(timeseries_key(granularity))
+            ]):
+                merged = rows.setdefault(row["_id"], dict(row, total_buy=0, total_sell=0, buy_count=0,
+                                                          sell_count=0, count=0))
+                for field in ("total_buy", "total_sell", "buy_count", "sell_count", "count"):
+                    merged[field] += row[field]
+
+        ordered = sorted(rows.values(), key=lambda row: (row["_id"] is not None, row["_id"] or ""))
+        return timeseries_rows(ordered)
+
+
+def open_store(db, kind=PRODUCT_STORAGE):
+    if kind == "documents":
+        return DocumentStore(db)
+    if kind == "buckets":
+        return BucketStore(db)
+    raise ValueError(f"Unknown PRODUCT_STORAGE: {kind}")
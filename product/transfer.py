@@ -0,0 +1,190 @@
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import zlib
+
+from fastjson import dumps
+from pagination import STREAM_BATCH_SIZE, STREAM_CHUNK_SIZE
+
+# Rows parsed, validated and inserted together while importing
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+# Bytes of an import body kept in memory; the rest is spooled to a temp file
+IMPORT_SPOOL_SIZE = int(os.getenv("IMPORT_SPOOL_SIZE", str(8 * 1024 * 1024)))
+
+IMPORT_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "text/csv": "csv",
+}
+EXPORT_MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Columns read from an imported CSV; price and quantity are numbers
+CSV_COLUMNS = ("name", "price", "quantity", "type", "date")
+CSV_NUMBER_COLUMNS = ("price", "quantity")
+
+
+class TransferError(ValueError):
+    pass
+
+
+# Format of an import body, from ?format= or its Content-Type
+def import_format(request):
+    fmt = request.args.get("format") or IMPORT_FORMATS.get(request.mimetype)
+    if fmt not in EXPORT_MIMETYPES:
+        raise TransferError("Send the products as NDJSON (application/x-ndjson) or CSV (text/csv)")
+    return fmt
+
+
+# Decompression errors of a corrupt or truncated gzip body
+BODY_ERRORS = (OSError, EOFError, zlib.error)
+
+
+# Read the whole request body before answering. The import streams its
+# response, and a client that only reads once it has sent everything would
+# otherwise block against a server that is waiting to write. The caller closes
+# the returned file.
+def spool_body(request):
+    spool = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE)
+    try:
+        shutil.copyfileobj(request.stream, spool, STREAM_CHUNK_SIZE)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+# A spooled body as a binary stream, decompressed on the fly if the request
+# says it is gzipped. A body that does not even start as gzip is rejected up
+# front.
+def open_body(body, request):
+    stream = body
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        try:
+            stream.peek(1)
+        except BODY_ERRORS:
+            raise TransferError("The body is not valid gzip")
+    return stream
+
+
+class NonFiniteNumber(ValueError):
+    pass
+
+
+def parse_number(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = float(value)
+    if not math.isfinite(number):
+        raise NonFiniteNumber(value)
+    return number
+
+
+def reject_constant(name):
+    raise NonFiniteNumber(name)
+
+
+def parse_rows(stream, fmt):
+    if fmt == "ndjson":
+        for row, line in enumerate(stream):
+            if not line.strip():
+                continue
+            try:
+                yield row, json.loads(line, parse_constant=reject_constant), None
+            except NonFiniteNumber:
+                yield row, None, "Numbers must be finite"
+            except ValueError:
+                yield row, None, "Invalid JSON"
+        return
+
+    # Undecodable bytes become U+FFFD so that one bad row does not end the import
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline=""))
+    for row, record in enumerate(reader):
+        if any("\ufffd" in value for value in record.values() if isinstance(value, str)):
+            yield row, None, "Row is not valid UTF-8"
+            continue
+        data = {column: record[column] for column in CSV_COLUMNS if record.get(column) not in (None, "")}
+        try:
+            for column in CSV_NUMBER_COLUMNS:
+                if column in data:
+                    data[column] = parse_number(data[column])
+        except ValueError:
+            yield row, None, f"'{column}' must be a finite number"
+            continue
+        yield row, data, None
+
+
+# Yield (row, data, error) for every row of the body, one line at a time.
+# data is None when the row could not be parsed. A body that turns out to be
+# corrupt part way through ends with one error row; the rows before it are
+# still returned.
+def read_rows(stream, fmt):
+    row = -1
+    try:
+        for row, data, error in parse_rows(stream, fmt):
+            yield row, data, error
+    except BODY_ERRORS as e:
+        yield row + 1, None, f"The body could not be read past this row: {str(e)}"
+
+
+# Group rows into lists of at most size without reading further ahead
+def batches(rows, size=IMPORT_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Encode documents as NDJSON or CSV, yielding chunks of STREAM_CHUNK_SIZE bytes
+def encode_rows(docs, serialize, fmt, columns):
+    if hasattr(docs, "batch_size"):
+        docs = docs.batch_size(STREAM_BATCH_SIZE)
+    if fmt == "ndjson":
+        buffer = []
+        size = 0
+        for doc in docs:
+            line = dumps(serialize(doc)) + b"\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= STREAM_CHUNK_SIZE:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield b"".join(buffer)
+        return
+
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for doc in docs:
+        row = serialize(doc)
+        writer.writerow(["" if row.get(column) is None else str(row[column]) for column in columns])
+        if text.tell() >= STREAM_CHUNK_SIZE:
+            yield text.getvalue().encode()
+            text.seek(0)
+            text.truncate()
+    if text.tell():
+        yield text.getvalue().encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,54 @@
+# Tests of the change feed and the caches it invalidates. They need a MongoDB
+# replica set, since change streams do not exist on a standalone server; the
+# mongo service of docker-compose.yml is a single-node one:
+#
+#   docker compose up -d mongo
+#   CHANGEFEED_TEST_MONGO_URI="mongodb://localhost:27017/?directConnection=true" python -m pytest tests
+#
+# Without CHANGEFEED_TEST_MONGO_URI every test is skipped.
+import os
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MONGO_URI = os.getenv("CHANGEFEED_TEST_MONGO_URI")
+
+# Databases of this run, so tests never touch a service's real data
+RUN_ID = uuid.uuid4().hex[:8]
+for name in ("inventory", "product", "user"):
+    os.environ[f"{name.upper()}_DB_NAME"] = f"changefeed_test_{RUN_ID}_{name}"
+os.environ["CHANGEFEED_ENABLED"] = "1"
+os.environ["CHANGEFEED_CHECKPOINT_INTERVAL"] = "0"
+os.environ["CHANGEFEED_MAX_AWAIT_MS"] = "100"
+os.environ["CHANGEFEED_RETRY_INTERVAL"] = "0.5"
+# Revocations must arrive through the feed (or the first sync), not a poll
+os.environ["REVOCATION_SYNC_INTERVAL"] = "3600"
+
+# The shared modules are identical in every service; test the product copies
+sys.path.insert(0, os.path.join(ROOT, "product"))
+
+
+@pytest.fixture(scope="session")
+def client():
+    if not MONGO_URI:
+        pytest.skip("CHANGEFEED_TEST_MONGO_URI is not set")
+    from pymongo import MongoClient
+
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    if "setName" not in client.admin.command("ismaster"):
+        pytest.skip("CHANGEFEED_TEST_MONGO_URI is not a replica set")
+    yield client
+    import changefeed
+
+    for database in changefeed.DATABASES.values():
+        client.drop_database(database)
+    client.close()
+
+
+@pytest.fixture
+def db(client):
+    import changefeed
+
+    return {name: client[database] for name, database in changefeed.DATABASES.items()}
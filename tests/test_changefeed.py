@@ -0,0 +1,160 @@
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token
+
+import auth
+import changefeed
+import ownership
+import revocation
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+@pytest.fixture
+def start_feed(client, db):
+    feeds = []
+
+    # Start a feed with the given subscriptions and wait until every stream
+    # is open, so writes made afterwards are seen
+    def start(name, *subscribers):
+        feed = changefeed.ChangeFeed()
+        for subscribe in subscribers:
+            subscribe(feed)
+        tokens = db["product"].changefeed_tokens
+        feed.init_app(client, tokens, name)
+        feeds.append(feed)
+        assert wait_for(lambda: all(tokens.find_one({"_id": f"{name}:{database}"}) for database in feed.subscriptions))
+        return feed
+
+    yield start
+    for feed in feeds:
+        feed.stop()
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = Flask(__name__)
+    app.config["JWT_SECRET_KEY"] = "changefeed-test"
+    JWTManager(app)
+    return app
+
+
+@pytest.fixture(scope="module")
+def revocations(client):
+    revocation.revoked_tokens.init_app(client[changefeed.DATABASES["user"]].revoked_tokens)
+    return revocation.revoked_tokens
+
+
+def issue_token(app, user_id):
+    with app.app_context():
+        return create_access_token(identity=user_id, additional_claims={"username": "user", "email": "user@example.com"})
+
+
+def revoke(db, app, token):
+    with app.app_context():
+        from flask_jwt_extended import decode_token
+
+        claims = decode_token(token)
+    db["user"].revoked_tokens.insert_one({
+        "_id": claims["jti"],
+        "expires_at": datetime.fromtimestamp(claims["exp"], timezone.utc),
+        "revoked_at": datetime.now(timezone.utc)
+    })
+    return claims["jti"]
+
+
+def test_inventory_writes_invalidate_ownership(db, start_feed):
+    updated = db["inventory"].inventory.insert_one({"name": "updated", "user_id": "u1"}).inserted_id
+    deleted = db["inventory"].inventory.insert_one({"name": "deleted", "user_id": "u1"}).inserted_id
+    kept = db["inventory"].inventory.insert_one({"name": "kept", "user_id": "u1"}).inserted_id
+    for inventory_id in (updated, deleted, kept):
+        ownership.remember_ownership("u1", str(inventory_id), True)
+
+    start_feed("ownership", ownership.subscribe)
+    db["inventory"].inventory.update_one({"_id": updated}, {"$set": {"user_id": "u2"}})
+    db["inventory"].inventory.delete_one({"_id": deleted})
+
+    assert wait_for(lambda: ownership.cached_ownership("u1", str(updated)) is None)
+    assert wait_for(lambda: ownership.cached_ownership("u1", str(deleted)) is None)
+    assert ownership.cached_ownership("u1", str(kept)) is True
+
+
+def test_token_revoked_after_start_is_refused(app, db, revocations, start_feed):
+    user_id = str(ObjectId())
+    token = issue_token(app, user_id)
+    start_feed("auth", auth.subscribe)
+
+    with app.app_context():
+        assert auth.authenticate(token)[0] == user_id
+        revoke(db, app, token)
+        assert wait_for(lambda: auth.authenticate(token)[3] == "Token has been revoked")
+
+
+def test_account_change_drops_cached_identity(app, db, revocations, start_feed):
+    user_id = db["user"].user.insert_one({"username": "user", "email": "user@example.com"}).inserted_id
+    token = issue_token(app, str(user_id))
+    start_feed("identity", auth.subscribe)
+
+    with app.app_context():
+        auth.authenticate(token)
+    assert auth.identity_cache.get(token)
+    db["user"].user.update_one({"_id": user_id}, {"$set": {"email": "new@example.com"}})
+    assert wait_for(lambda: auth.identity_cache.get(token) is None)
+
+
+# A new worker resumes from the shared token, past revocations written before
+# it started; it must still refuse them
+def test_new_worker_loads_earlier_revocations(app, client, db):
+    jti = revoke(db, app, issue_token(app, str(ObjectId())))
+
+    revoked_tokens = revocation.RevocationList()
+    revoked_tokens.init_app(client[changefeed.DATABASES["user"]].revoked_tokens)
+    assert revoked_tokens.is_revoked(jti)
+
+
+def test_reset_reloads_revocations(app, client, db):
+    revoked_tokens = revocation.RevocationList()
+    revoked_tokens.init_app(client[changefeed.DATABASES["user"]].revoked_tokens)
+    assert not revoked_tokens.is_revoked("missed")
+
+    # Written while the feed was not delivering events
+    db["user"].revoked_tokens.insert_one({
+        "_id": "missed",
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+        "revoked_at": datetime.now(timezone.utc)
+    })
+    feed = changefeed.ChangeFeed()
+    revoked_tokens.subscribe(feed)
+    feed.reset()
+    assert revoked_tokens.is_revoked("missed")
+
+
+def test_resumes_from_stored_token(db, start_feed):
+    collection = db["inventory"].inventory
+    name = f"resume-{uuid.uuid4().hex[:8]}"
+    first_seen = []
+    second_seen = []
+
+    feed = start_feed(name, lambda feed: feed.subscribe(
+        "inventory", "inventory", lambda event: first_seen.append(event["documentKey"]["_id"]), operations=("insert",)))
+    before = collection.insert_one({"name": "before restart"}).inserted_id
+    assert wait_for(lambda: before in first_seen)
+    feed.stop()
+
+    during = collection.insert_one({"name": "while stopped"}).inserted_id
+    start_feed(name, lambda feed: feed.subscribe(
+        "inventory", "inventory", lambda event: second_seen.append(event["documentKey"]["_id"]), operations=("insert",)))
+    assert wait_for(lambda: during in second_seen)
+    assert before not in second_seen
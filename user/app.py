@@ -1,16 +1,22 @@
 from flask import Flask, jsonify, request
 from flask_pymongo import PyMongo
 from bson import ObjectId
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from flask_jwt_extended.utils import decode_token  # Import decode_token for manual decoding
 from datetime import timedelta
 import os
 from dotenv import load_dotenv
-from werkzeug.security import generate_password_hash, check_password_hash
-
-# Use pbkdf2:sha256 as the hashing algorithm
-
+import client
+import resilience
+import metrics
+import tracing
+import fastjson
+import hashing
+from revocation import revoked_tokens
+import indexes
+import changefeed
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,15 +25,53 @@ app = Flask(__name__)
 
 # MongoDB configuration
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")  # Set this in your .env file
-mongo = PyMongo(app)
+# connect=False defers connecting until first use, which keeps the client
+# fork-safe; the pool size is per worker process
+mongo = PyMongo(app, connect=False, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+                event_listeners=[metrics.mongo_listener])
 
 # JWT Configuration
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")   # Replace with a strong secret key
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(days=1)  # Set token expiry to 1 day
 jwt = JWTManager(app)
+client.init_app(app)
+resilience.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, "user")
+fastjson.init_app(app)
 
 # Collection references
 users_collection = mongo.db.user  
+# Revoked token ids, removed by the TTL index once the token has expired
+revoked_tokens_collection = mongo.db.revoked_tokens
+
+# Unique logins; documents without a string value are left out of the index
+indexes.init_app(app, [
+    (users_collection, [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True,
+                   partialFilterExpression={"email": {"$type": "string"}}),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True,
+                   partialFilterExpression={"username": {"$type": "string"}})
+    ]),
+    (revoked_tokens_collection, [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        IndexModel([("revoked_at", ASCENDING)], name="revoked_at")
+    ])
+])
+revoked_tokens.init_app(revoked_tokens_collection)
+revoked_tokens.subscribe(changefeed.feed)
+changefeed.feed.init_app(mongo.cx, mongo.db.changefeed_tokens, "user")
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    return revoked_tokens.is_revoked(jwt_payload.get("jti"))
+
+# Shed login bursts instead of queueing them without bound
+@app.errorhandler(hashing.HashingBusy)
+def hashing_busy(e):
+    response = jsonify({"msg": "Service is busy, please retry"})
+    response.headers["Retry-After"] = str(hashing.HASH_RETRY_AFTER)
+    return response, 503
 
 ### Route: Get User ID Only (Retrieve user ID by token)
 @app.route('/user_id', methods=['GET'])
@@ -39,10 +83,14 @@ def user_id():
     
     token = auth_header
     try:
-        user_id = decode_token(token)["sub"]  # Get the user ID from the token's 'sub' field
+        claims = decode_token(token)
+        user_id = claims["sub"]  # Get the user ID from the token's 'sub' field
     except Exception as e:
         return jsonify({"msg": f"Invalid token: {str(e)}"}), 401
 
+    if revoked_tokens.is_revoked(claims.get("jti")):
+        return jsonify({"msg": "Invalid token: Token has been revoked"}), 401
+
     # Check if the user exists
     user = users_collection.find_one({"_id": ObjectId(user_id)})
     if user:
@@ -57,23 +105,37 @@ def user_id():
 ### Route: Sign-Up (User Registration)
 @app.route('/signup', methods=['POST'])
 def signup():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"msg": "Invalid input data. Required fields: 'username', 'email', 'password'."}), 400
     username = data.get("username")
     email = data.get("email")
     password = data.get("password")
-    # Check if email already exists
-    if users_collection.find_one({"email": email}):
-        return jsonify({"msg": "Email already exists"}), 409
-
-    # Hash the password and store new user in MongoDB
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+    # Until the unique indexes exist, check for an existing login up front
+    if not indexes.index_ready(users_collection.name, "email_unique"):
+        if users_collection.find_one({"email": email}):
+            return jsonify({"msg": "Email already exists"}), 409
+    if not indexes.index_ready(users_collection.name, "username_unique"):
+        if users_collection.find_one({"username": username}):
+            return jsonify({"msg": "Username already exists"}), 409
+
+    # Hash the password off the request thread and store new user in MongoDB
+    hashed_password = hashing.hash_password(password)
     
-    users_collection.insert_one({
-        "username": username,
-        "email": email,
-        "password": hashed_password,
-        "token": None  # Initialize token as None
-    })
+    try:
+        users_collection.insert_one({
+            "username": username,
+            "email": email,
+            "password": hashed_password
+        })
+    except DuplicateKeyError as e:
+        # The unique indexes reject an existing email or username; older
+        # servers only name the index in the error message
+        details = e.details or {}
+        if ("username" in details.get("keyPattern", {}) or "username" in details.get("keyValue", {})
+                or "username_unique" in details.get("errmsg", str(e))):
+            return jsonify({"msg": "Username already exists"}), 409
+        return jsonify({"msg": "Email already exists"}), 409
     return jsonify({"msg": "User created successfully"}), 201
 
 ### Route: Sign-In (Authenticate and Get JWT Token)
@@ -85,18 +147,27 @@ def signin():
     # Find user by username
     user = users_collection.find_one({"username": username})
     
-    if user and check_password_hash(user["password"], password):
-        # Create JWT token for the user
-        access_token = create_access_token(identity=str(user["_id"]))
+    if user and hashing.verify_password(user["password"], password):
+        # Upgrade hashes made with an older work factor, unless the password
+        # changed in the meantime
+        if hashing.needs_rehash(user["password"]):
+            hashing.rehash_in_background(password, lambda new_hash: users_collection.update_one(
+                {"_id": user["_id"], "password": user["password"]},
+                {"$set": {"password": new_hash}}
+            ))
+
+        # Create JWT token for the user, carrying the identity claims so the
+        # other services can authenticate it without calling back here
+        access_token = create_access_token(
+            identity=str(user["_id"]),
+            additional_claims={"username": user["username"], "email": user["email"]}
+        )
 
-        # Update user document with the new token
-        users_collection.update_one({"_id": user["_id"]}, {"$set": {"token": access_token}})
-        
         return jsonify(access_token=access_token), 200
 
     return jsonify({"msg": "Invalid username or password"}), 401
 
-### Route: Logout (Clear JWT Token)
+### Route: Logout (Revoke JWT Token)
 @app.route('/logout', methods=['POST'])
 def logout():
     # Retrieve the token from the Authorization header
@@ -107,13 +178,23 @@ def logout():
     # Extract the token from the header
     token=auth_header
     try:
-        user_id = decode_token(token)["sub"]  # Get the user ID from the token's 'sub' field
+        claims = decode_token(token)
     except Exception as e:
         return jsonify({"msg": f"Invalid token: {str(e)}"}), 401
 
-    users_collection.update_one({"_id": ObjectId(user_id)}, {"$set": {"token": None}})
+    # Revoke this token until it would have expired anyway
+    revoked_tokens.revoke(claims["jti"], claims["exp"])
     return jsonify({"msg": "Logged out successfully"}), 200
 
 
+# Release pooled connections when a worker stops
+def shutdown():
+    changefeed.feed.stop()
+    client.close_clients()
+    hashing.shutdown()
+    mongo.cx.close()
+
+
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    app.run(host="0.0.0.0", port=5001, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Change streams need a replica set; without one the feed stays off and the
+# caches rely on their TTLs alone
+CHANGEFEED_ENABLED = os.getenv("CHANGEFEED_ENABLED", "0") == "1"
+CHANGEFEED_RETRY_INTERVAL = float(os.getenv("CHANGEFEED_RETRY_INTERVAL", "5"))
+# How often the resume token of each stream is stored (seconds)
+CHANGEFEED_CHECKPOINT_INTERVAL = float(os.getenv("CHANGEFEED_CHECKPOINT_INTERVAL", "5"))
+CHANGEFEED_MAX_AWAIT_MS = int(os.getenv("CHANGEFEED_MAX_AWAIT_MS", "1000"))
+
+# Database of each service, as named in its MONGO_URI
+DATABASES = {name: os.getenv(f"{name.upper()}_DB_NAME", name) for name in ("inventory", "product", "user")}
+
+# The resume token is no longer in the oplog or cannot be used
+RESUME_FAILED_CODES = (136, 260, 280, 286)
+
+
+# Tails the change streams of the service databases and hands each write to
+# the caches that subscribed to its collection. Every worker process runs its
+# own feed, since every worker has its own caches.
+class ChangeFeed:
+    def __init__(self):
+        # database -> [(collection, operations, on_change)]
+        self.subscriptions = {}
+        # Called when events may have been missed, to drop what they guard
+        self.resets = []
+        self.client = None
+        self.tokens = None
+        self.name = None
+        self.threads = []
+        self._stopped = threading.Event()
+
+    def subscribe(self, database, collection, on_change, operations=("update", "replace", "delete"), on_reset=None):
+        self.subscriptions.setdefault(database, []).append((collection, tuple(operations), on_change))
+        if on_reset is not None:
+            self.resets.append(on_reset)
+
+    def publish(self, database, event):
+        collection = event.get("ns", {}).get("coll")
+        for subscribed, operations, on_change in self.subscriptions.get(database, []):
+            if subscribed == collection and event["operationType"] in operations:
+                try:
+                    on_change(event)
+                except Exception:
+                    logging.exception(f"Failed to handle a change to {database}.{collection}")
+
+    def reset(self):
+        for on_reset in self.resets:
+            try:
+                on_reset()
+            except Exception:
+                logging.exception("Failed to reset a cache after losing change stream events")
+
+    def _pipeline(self, database):
+        subscriptions = self.subscriptions[database]
+        return [{"$match": {
+            "ns.coll": {"$in": sorted({collection for collection, _, _ in subscriptions})},
+            "operationType": {"$in": sorted({op for _, operations, _ in subscriptions for op in operations})}
+        }}]
+
+    # Resume tokens are stored per service and database in the service's own
+    # database, and the workers of a service share them. A new worker resumes
+    # from wherever another worker got to, so it must not rely on the feed for
+    # writes made before it started: its caches start empty, and state that
+    # has to be complete, like the revocation list, is loaded from the
+    # database at startup and on every reset.
+    def _load_token(self, token_id):
+        try:
+            stored = self.tokens.find_one({"_id": token_id})
+        except PyMongoError as e:
+            logging.warning(f"Failed to load the change stream resume token {token_id}: {str(e)}")
+            return None
+        return stored["token"] if stored else None
+
+    def _store_token(self, token_id, token):
+        try:
+            self.tokens.update_one(
+                {"_id": token_id},
+                {"$set": {"token": token, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logging.warning(f"Failed to store the change stream resume token {token_id}: {str(e)}")
+
+    def tail(self, database):
+        token_id = f"{self.name}:{database}"
+        resume_after = self._load_token(token_id)
+        pipeline = self._pipeline(database)
+
+        while not self._stopped.is_set():
+            stored = resume_after
+            checkpointed = time.monotonic()
+            try:
+                with self.client[DATABASES[database]].watch(
+                    pipeline, resume_after=resume_after, max_await_time_ms=CHANGEFEED_MAX_AWAIT_MS
+                ) as stream:
+                    while stream.alive and not self._stopped.is_set():
+                        event = stream.try_next()
+                        if event is not None:
+                            self.publish(database, event)
+                        resume_after = stream.resume_token
+                        if resume_after != stored and time.monotonic() - checkpointed >= CHANGEFEED_CHECKPOINT_INTERVAL:
+                            self._store_token(token_id, resume_after)
+                            stored = resume_after
+                            checkpointed = time.monotonic()
+                if resume_after != stored:
+                    self._store_token(token_id, resume_after)
+            except OperationFailure as e:
+                if resume_after is not None and e.code in RESUME_FAILED_CODES:
+                    # Changes since the token are gone; start over from now
+                    # and drop everything that may have missed them
+                    logging.warning(f"Cannot resume the {database} change stream, resetting caches: {str(e)}")
+                    resume_after = None
+                    self.reset()
+                    continue
+                logging.warning(f"The {database} change stream failed: {str(e)}")
+            except PyMongoError as e:
+                logging.warning(f"The {database} change stream failed: {str(e)}")
+            self._stopped.wait(CHANGEFEED_RETRY_INTERVAL)
+
+    def init_app(self, client, tokens_collection, name):
+        self.client = client
+        self.tokens = tokens_collection
+        self.name = name
+        if not CHANGEFEED_ENABLED:
+            return
+        for database in self.subscriptions:
+            thread = threading.Thread(target=self.tail, args=(database,), name=f"changefeed-{database}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stop tailing and store how far each stream got
+    def stop(self, timeout=5):
+        self._stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+feed = ChangeFeed()
@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+
+# Pre-fork serving for the user service: gunicorn -c gunicorn.conf.py app:app
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# Each worker is a separate process with its own threads, so a container can
+# use more than one core
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+
+# The app is imported in every worker after fork, so the MongoClient, HTTP
+# sessions and background threads are never shared across processes
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+
+
+def worker_exit(server, worker):
+    # Close pooled connections once in-flight requests have finished
+    from app import shutdown
+    shutdown()
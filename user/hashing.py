@@ -0,0 +1,121 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# pbkdf2 work factor for new hashes; older hashes are upgraded on login
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "260000"))
+PASSWORD_HASH_METHOD = f"pbkdf2:sha256:{PASSWORD_HASH_ITERATIONS}"
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+# Hashing jobs allowed to run or wait at once before new ones are turned away
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "64"))
+HASH_TIMEOUT = float(os.getenv("HASH_TIMEOUT", "10"))
+HASH_RETRY_AFTER = int(os.getenv("HASH_RETRY_AFTER", "1"))
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HASH_QUEUE_SIZE)
+
+
+# Created lazily so each gunicorn worker gets its own pool after fork. The
+# forkserver context avoids forking a process that already runs threads.
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=HASH_WORKERS,
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+    return _executor
+
+
+# A pool whose worker died stays broken; drop it so the next call starts a
+# fresh one. Only the broken pool is dropped if another thread got there first.
+def _discard_executor(broken):
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+
+# Queue fn on the hashing pool, or raise HashingBusy when the queue is full
+# or the pool cannot take work even after being restarted once
+def submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy("Too many password operations in progress")
+    try:
+        for attempt in range(2):
+            executor = _get_executor()
+            try:
+                future = executor.submit(fn, *args)
+                break
+            except BrokenProcessPool:
+                logging.warning("Password hashing pool broke, restarting it")
+                _discard_executor(executor)
+        else:
+            raise HashingBusy("Password hashing pool is unavailable")
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    return future
+
+
+# Wait for a hashing job; a job that runs too long or whose worker died is
+# reported as HashingBusy so the caller answers 503 rather than 500
+def _result(future):
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        raise HashingBusy("Password operation timed out")
+    except BrokenProcessPool:
+        # submit restarts the pool on the next call
+        raise HashingBusy("Password hashing pool is unavailable")
+
+
+def hash_password(password):
+    return _result(submit(generate_password_hash, password, PASSWORD_HASH_METHOD))
+
+
+def verify_password(pwhash, password):
+    return _result(submit(check_password_hash, pwhash, password))
+
+
+# True when a stored hash was made with a different method or work factor
+def needs_rehash(pwhash):
+    return pwhash.split("$", 1)[0] != PASSWORD_HASH_METHOD
+
+
+# Hash the password again with the current settings and hand the result to
+# on_hashed; skipped when the pool is busy since the next login can retry
+def rehash_in_background(password, on_hashed):
+    try:
+        future = submit(generate_password_hash, password, PASSWORD_HASH_METHOD)
+    except HashingBusy:
+        return
+
+    def done(f):
+        try:
+            on_hashed(f.result())
+        except Exception as e:
+            logging.warning(f"Failed to upgrade password hash: {str(e)}")
+
+    future.add_done_callback(done)
+
+
+def shutdown():
+    if _executor is not None:
+        _executor.shutdown(wait=False)
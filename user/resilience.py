@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from flask import jsonify, request
+
+import metrics
+
+# Circuit breaker settings, shared by every downstream service
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "20"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_SLOW_CALL_DURATION = float(os.getenv("CIRCUIT_SLOW_CALL_DURATION", "2"))
+CIRCUIT_OPEN_DURATION = float(os.getenv("CIRCUIT_OPEN_DURATION", "10"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "3"))
+
+# Requests served at once by one worker process; 0 disables the limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "0"))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Raised instead of calling a service whose circuit is open. It is a
+# ConnectionError so callers that tolerate an unreachable service keep working.
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} service is unavailable")
+        self.service = service
+        self.retry_after = retry_after
+
+
+# Stops calling a service once too many recent calls failed or were slow.
+# After CIRCUIT_OPEN_DURATION a few probe calls are let through; the circuit
+# closes again if they all succeed and reopens on the first bad one.
+class CircuitBreaker:
+    def __init__(self, name, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS,
+                 failure_rate=CIRCUIT_FAILURE_RATE, slow_call_rate=CIRCUIT_SLOW_CALL_RATE,
+                 slow_call_duration=CIRCUIT_SLOW_CALL_DURATION, open_duration=CIRCUIT_OPEN_DURATION,
+                 half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+
+        self.state = CLOSED
+        self._calls = deque()  # (finished_at, failed, slow)
+        self._opened_at = 0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        self.state = state
+        metrics.CIRCUIT_TRANSITIONS.inc(service=self.name, state=state)
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == HALF_OPEN:
+            self._probes = 0
+            self._probe_successes = 0
+        self._calls.clear()
+
+    def retry_after(self):
+        return max(self._opened_at + self.open_duration - time.monotonic(), 0)
+
+    # Raise CircuitOpenError unless a call may be made now
+    def before_call(self):
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_after() > 0:
+                    metrics.CIRCUIT_REJECTIONS.inc(service=self.name)
+                    raise CircuitOpenError(self.name, self.retry_after())
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    metrics.CIRCUIT_REJECTIONS.inc(service=self.name)
+                    raise CircuitOpenError(self.name, self.open_duration)
+                self._probes += 1
+
+    def record(self, duration, failed):
+        slow = duration >= self.slow_call_duration
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED)
+                return
+            if self.state == OPEN:
+                return
+
+            self._calls.append((now, failed, slow))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for call in self._calls if call[1])
+            slow_calls = sum(1 for call in self._calls if call[2])
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                self._transition(OPEN)
+
+
+# Reject requests beyond MAX_CONCURRENT_REQUESTS with 503 instead of letting
+# them queue behind slow ones, and answer 503 while a dependency's circuit is open
+def init_app(app, exempt=("/metrics",)):
+    limiter = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS) if MAX_CONCURRENT_REQUESTS > 0 else None
+
+    if limiter is not None:
+        @app.before_request
+        def admit_request():
+            if request.path in exempt:
+                return None
+            if not limiter.acquire(blocking=False):
+                metrics.SHED_REQUESTS.inc()
+                response = jsonify({"msg": "Service is overloaded, try again later"})
+                response.headers["Retry-After"] = str(SHED_RETRY_AFTER)
+                return response, 503
+            request.environ["resilience.admitted"] = threading.get_ident()
+
+        # Fan-out threads tear down copies of the same request context while
+        # the request is still running, so only the thread that admitted the
+        # request releases its slot
+        @app.teardown_request
+        def release_request(exc):
+            if request.environ.get("resilience.admitted") == threading.get_ident():
+                del request.environ["resilience.admitted"]
+                limiter.release()
+
+    @app.errorhandler(CircuitOpenError)
+    def circuit_open(e):
+        response = jsonify({"msg": str(e)})
+        response.headers["Retry-After"] = str(max(int(e.retry_after + 0.999), 1))
+        return response, 503
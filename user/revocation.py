@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo.errors import PyMongoError
+
+# How often each worker picks up revocations made by other workers (seconds)
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+# How long lookups made right after startup wait for the first sync (seconds)
+REVOCATION_LOAD_TIMEOUT = float(os.getenv("REVOCATION_LOAD_TIMEOUT", "5"))
+
+
+# In-process set of revoked token ids (jti) with their expiry. Lookups are a
+# dict hit with no I/O; every revocation is also written to a small collection
+# whose TTL index removes it once the token would have expired anyway. The
+# user service writes the collection; the other services only sync from it.
+class RevocationList:
+    def __init__(self):
+        self.collection = None
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._synced_until = datetime.fromtimestamp(0, timezone.utc)
+        # Set once the first sync, which loads every stored revocation, has
+        # been tried
+        self._first_sync = threading.Event()
+
+    def revoke(self, jti, expires_at):
+        with self._lock:
+            self._revoked[jti] = expires_at
+        now = datetime.now(timezone.utc)
+        self.collection.update_one(
+            {"_id": jti},
+            {"$set": {
+                "expires_at": datetime.fromtimestamp(expires_at, timezone.utc),
+                "revoked_at": now
+            }},
+            upsert=True
+        )
+
+    def is_revoked(self, jti):
+        if not self._first_sync.is_set():
+            self._first_sync.wait(REVOCATION_LOAD_TIMEOUT)
+        expires_at = self._revoked.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    # Forget revocations of tokens that have expired on their own
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            for jti in [jti for jti, expires_at in self._revoked.items() if expires_at <= now]:
+                del self._revoked[jti]
+
+    # Load revocations written since the last sync, including other workers'
+    def sync(self):
+        started = datetime.now(timezone.utc)
+        for doc in self.collection.find({"revoked_at": {"$gte": self._synced_until}}):
+            expires_at = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+            with self._lock:
+                self._revoked[doc["_id"]] = expires_at
+        # Overlap a little so writes racing with this read are not missed
+        self._synced_until = started.replace(microsecond=0)
+
+    def on_change(self, event):
+        document = event.get("fullDocument") or event.get("updateDescription", {}).get("updatedFields", {})
+        if "expires_at" in document:
+            with self._lock:
+                self._revoked[event["documentKey"]["_id"]] = document["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+
+    # Learn about other workers' revocations as they happen instead of at the
+    # next sync. The first sync loads every stored revocation, so a new worker
+    # does not depend on the feed for older ones; events the feed loses are
+    # loaded again when it resets.
+    def subscribe(self, feed):
+        feed.subscribe("user", "revoked_tokens", self.on_change, operations=("insert", "update", "replace"),
+                       on_reset=self.reload)
+
+    # Load every stored revocation again, for when recent ones may have been
+    # missed
+    def reload(self):
+        self._synced_until = datetime.fromtimestamp(0, timezone.utc)
+        self.sync()
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+                self.prune()
+            except PyMongoError as e:
+                logging.warning(f"Failed to sync revoked tokens: {str(e)}")
+            self._first_sync.set()
+            time.sleep(REVOCATION_SYNC_INTERVAL)
+
+    def init_app(self, collection):
+        self.collection = collection
+        threading.Thread(target=self.run, name="revocation-sync", daemon=True).start()
+
+
+revoked_tokens = RevocationList()
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+from flask import g, has_request_context, request
+
+# Request id shared by every call made on behalf of one client request, and
+# the id of the span that made the call
+REQUEST_ID_HEADER = "X-Request-ID"
+PARENT_SPAN_HEADER = "X-Span-ID"
+
+# Spans are written as Zipkin v2 JSON: one span per line to a file, and/or in
+# batches to a collector such as http://zipkin:9411/api/v2/spans
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))
+
+_HEX_TRACE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+# Zipkin trace ids are 32 hex digits; other request ids are hashed into one
+def trace_id_for(request_id):
+    if _HEX_TRACE_ID.match(request_id):
+        return request_id
+    return hashlib.md5(request_id.encode()).hexdigest()
+
+
+class SpanExporter:
+    def __init__(self, path=None, collector_url=None):
+        self.path = path
+        self.collector_url = collector_url
+        self.enabled = bool(path or collector_url)
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Tracing must never slow requests down; drop the span instead
+            pass
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(TRACE_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        spans = []
+        while True:
+            try:
+                spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not spans:
+            return
+        try:
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write("".join(json.dumps(span) + "\n" for span in spans))
+            if self.collector_url:
+                requests.post(self.collector_url, json=spans, timeout=5)
+        except (OSError, requests.exceptions.RequestException) as e:
+            logging.warning(f"Failed to export {len(spans)} spans: {str(e)}")
+
+
+exporter = SpanExporter(TRACE_EXPORT_PATH, TRACE_COLLECTOR_URL)
+service_name = "unknown"
+
+
+def record_span(name, kind, trace_id, span_id, parent_id, started, duration, tags=None):
+    span = {
+        "traceId": trace_id,
+        "id": span_id,
+        "name": name,
+        "kind": kind,
+        "timestamp": int(started * 1e6),
+        "duration": max(int(duration * 1e6), 1),
+        "localEndpoint": {"serviceName": service_name},
+        "tags": {key: str(value) for key, value in (tags or {}).items()},
+    }
+    if parent_id:
+        span["parentId"] = parent_id
+    exporter.export(span)
+
+
+def current_request_id():
+    return g.get("request_id") if has_request_context() else None
+
+
+# Span around an outgoing call to another service. The yielded dict holds the
+# headers to send and tags the caller may add to.
+@contextmanager
+def client_span(service, method, path):
+    if has_request_context() and g.get("trace_id"):
+        request_id, trace_id, parent_id = g.request_id, g.trace_id, g.span_id
+    else:
+        # Background work such as the outbox worker starts its own trace
+        request_id = uuid.uuid4().hex
+        trace_id, parent_id = request_id, None
+
+    span_id = new_span_id()
+    span = {
+        "headers": {REQUEST_ID_HEADER: request_id, PARENT_SPAN_HEADER: span_id},
+        "tags": {"http.method": method, "http.path": path, "peer.service": service},
+    }
+    started = time.time()
+    try:
+        yield span
+    finally:
+        record_span(f"{method} {service}{path}", "CLIENT", trace_id, span_id, parent_id,
+                    started, time.time() - started, span["tags"])
+
+
+# Accept or generate a request id for every request and record a server span
+def init_app(app, name):
+    global service_name
+    service_name = name
+
+    @app.before_request
+    def start_span():
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        g.trace_id = trace_id_for(g.request_id)
+        g.parent_span_id = request.headers.get(PARENT_SPAN_HEADER)
+        g.span_id = new_span_id()
+        g.span_started = time.time()
+
+    @app.after_request
+    def finish_span(response):
+        if g.get("span_id") is None:
+            return response
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        record_span(f"{request.method} {route}", "SERVER", g.trace_id, g.span_id, g.parent_span_id,
+                    g.span_started, time.time() - g.span_started, {
+                        "http.method": request.method,
+                        "http.path": request.path,
+                        "http.status_code": response.status_code,
+                        "request_id": g.request_id,
+                    })
+        return response